@@ -42,7 +42,7 @@ if __name__ == '__main__':
     if "metrics" in config["training"]:
         metrics = parse.parse_metrics(config["training"]["metrics"], data_pipeline, session.device)
 
-    train_loader, test_loader = data_pipeline.get_data_loaders()
+    train_loader, test_loader = data_pipeline.get_data_loaders(prediction_pipeline.batch_adapter)
 
     if 'loss' in metrics:
         metrics['loss'] = session.criterion
@@ -11,13 +11,14 @@ class BatchAdapter:
     def __init__(self, hidden_size):
         self.hidden_size = hidden_size
 
-    def adapt(self, french_batch, english_batch):
+    def adapt(self, french_batch, english_batch, french_lengths=None, english_lengths=None):
         english_input = english_batch[:, :-1]
         english_target = english_batch[:, 1:]
 
-        hidden = torch.zeros(1, 1, self.hidden_size, device="cpu")
+        batch_size = len(french_batch)
+        hidden = torch.zeros(1, batch_size, self.hidden_size, device="cpu")
 
-        return {
+        batch = {
             "inputs": {
                 "encoder": {
                     "x": french_batch,
@@ -32,22 +33,35 @@ class BatchAdapter:
             }
         }
 
+        if french_lengths is not None:
+            batch["inputs"]["encoder"]["x_lengths"] = french_lengths
+        if english_lengths is not None:
+            # both shifted input and target are one token shorter than a sentence
+            batch["inputs"]["decoder"]["y_lengths"] = english_lengths - 1
+            batch["targets"]["y_lengths"] = english_lengths - 1
+        return batch
+
 
 class InferenceAdapter:
     def __init__(self, hidden_size):
         self.hidden_size = hidden_size
 
-    def adapt(self, french_batch):
-        hidden = torch.zeros(1, 1, self.hidden_size, device="cpu")
+    def adapt(self, french_batch, french_lengths=None):
+        batch_size = len(french_batch)
+        hidden = torch.zeros(1, batch_size, self.hidden_size, device="cpu")
 
-        return {
+        batch = {
             "inputs": {
                 "encoder": {
                     "x": french_batch,
                     "h": hidden
                 },
                 "decoder": {
-                    "sos": torch.LongTensor([[1]])
+                    "sos": torch.ones(batch_size, 1, dtype=torch.long)
                 }
             }
         }
+
+        if french_lengths is not None:
+            batch["inputs"]["encoder"]["x_lengths"] = french_lengths
+        return batch
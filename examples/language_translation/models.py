@@ -1,5 +1,8 @@
 from torch import nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
+
+from scaffolding.decoding import GreedySearch
 
 
 class Encoder(nn.Module):
@@ -9,13 +12,20 @@ class Encoder(nn.Module):
         self.embedding = nn.Embedding(input_size, hidden_size)
         self.gru = nn.GRU(hidden_size, hidden_size, batch_first=True)
 
-    def forward(self, x, hidden):
+    def forward(self, x, hidden, lengths=None):
         embedded = self.embedding(x)
-        output, hidden = self.gru(embedded, hidden)
+        if lengths is None:
+            output, hidden = self.gru(embedded, hidden)
+            return output, hidden
+
+        # padded steps are skipped by GRU, so hidden is the state after the last real token of each sentence
+        packed = pack_padded_sequence(embedded, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        output, hidden = self.gru(packed, hidden)
+        output, _ = pad_packed_sequence(output, batch_first=True, total_length=x.size(1))
         return output, hidden
 
-    def run_inference(self, x, hidden):
-        return self.forward(x, hidden)
+    def run_inference(self, x, hidden, lengths=None):
+        return self.forward(x, hidden, lengths)
 
 
 class Decoder(nn.Module):
@@ -28,23 +38,33 @@ class Decoder(nn.Module):
         self.gru = nn.GRU(hidden_size, hidden_size, batch_first=True)
         self.out = nn.Linear(hidden_size, output_size)
 
-    def forward(self, x, hidden):
+        # can be replaced (e.g. with BeamSearch) by "decoding" section of inference config
+        self.search = GreedySearch(eos=2, max_length=10)
+
+    def forward(self, x, hidden, lengths=None):
         output = self.embedding(x)
 
         output = F.relu(output)
 
-        output, hidden = self.gru(output, hidden)
-        output = self.out(output)
+        if lengths is None:
+            output, hidden = self.gru(output, hidden)
+            output = self.out(output)
+            return output, hidden
+
+        packed = pack_padded_sequence(output, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        packed, hidden = self.gru(packed, hidden)
+
+        # output layer is only applied to real (not padded) steps
+        packed = PackedSequence(self.out(packed.data), packed.batch_sizes,
+                                packed.sorted_indices, packed.unsorted_indices)
+        output, _ = pad_packed_sequence(packed, batch_first=True, total_length=x.size(1))
         return output, hidden
 
     def run_inference(self, x, hidden):
         # here x will mean SOS character
-        import torch
-        outputs = []
-        for i in range(10):
-            x, hidden = self.forward(x, hidden)
-            top = torch.argmax(x, dim=2).squeeze()
-            x = torch.LongTensor([[top]]).to(x.device)
-            outputs.append(top.item())
+        def step(tokens, state):
+            output, decoder_hidden = self.forward(tokens.unsqueeze(1), state[0])
+            return output.squeeze(1), (decoder_hidden,)
 
+        outputs = self.search(step, x[:, 0], (hidden,), batch_dims=(1,))
         return [outputs]
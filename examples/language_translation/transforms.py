@@ -10,13 +10,22 @@ class DecodeClassesTransform:
     def __init__(self, data_pipeline):
         self.data_pipeline = data_pipeline
 
-    def __call__(self, y_hat, ground_true):
+    def __call__(self, y_hat, ground_true, lengths=None):
         english_decoder = self.data_pipeline.preprocessors[1]
 
-        y_hat = y_hat.argmax(dim=2)[0].tolist()
-        ground_true = ground_true[0].tolist()
+        y_hat = y_hat.argmax(dim=2).tolist()
+        ground_true = ground_true.tolist()
 
-        predicted_text = ''.join([english_decoder.index2word.get(idx, 'OOV') for idx in y_hat])
-        actual_text = ''.join([english_decoder.index2word.get(idx, 'OOV') for idx in ground_true])
+        if lengths is None:
+            lengths = [len(y) for y in ground_true]
+        else:
+            lengths = lengths.tolist()
 
-        return [predicted_text], [actual_text]
+        def to_text(indices):
+            return ''.join([english_decoder.index2word.get(idx, 'OOV') for idx in indices])
+
+        # padded positions are left out, so that they do not affect the metric
+        predicted_texts = [to_text(y[:n]) for y, n in zip(y_hat, lengths)]
+        actual_texts = [to_text(y[:n]) for y, n in zip(ground_true, lengths)]
+
+        return predicted_texts, actual_texts
@@ -11,20 +11,18 @@ class InferenceAdapter:
     def __init__(self, alphabet_size, decoder_hidden_size):
         self.alphabet_size = alphabet_size
         self.hidden_size = decoder_hidden_size
-        self.eye = torch.eye(self.alphabet_size)
 
-    def adapt(self, images_batch):
-        if not hasattr(self, 'eye'):
-            self.eye = torch.eye(self.alphabet_size)
+    def adapt(self, images_batch, image_lengths=None):
+        if isinstance(images_batch, list):
+            images_batch = torch.stack(images_batch)
 
-        images_batch = torch.stack(images_batch)
+        batch_size = len(images_batch)
+        hidden = torch.zeros(1, batch_size, self.hidden_size, device="cpu")
 
-        hidden = torch.zeros(1, 1, self.hidden_size, device="cpu")
+        # index 1 is SOS (see TextPreProcessor), index 2 is EOS
+        sos = torch.ones(batch_size, dtype=torch.long)
 
-        sos = torch.zeros(1, self.alphabet_size)
-        sos[0, 2] = 1.0
-
-        return {
+        batch = {
             "inputs": {
                 "encoder": {
                     "x": images_batch
@@ -36,25 +34,29 @@ class InferenceAdapter:
             }
         }
 
+        if image_lengths is not None:
+            batch["inputs"]["encoder"]["x_widths"] = image_lengths
+        return batch
+
 
 class BatchAdapter:
     def __init__(self, alphabet_size, decoder_hidden_size):
         self.alphabet_size = alphabet_size
         self.hidden_size = decoder_hidden_size
-        self.eye = torch.eye(self.alphabet_size)
 
-    def adapt(self, images_batch, transcriptions_batch):
-        if not hasattr(self, 'eye'):
-            self.eye = torch.eye(self.alphabet_size)
+    def adapt(self, images_batch, transcriptions_batch, image_lengths=None, transcription_lengths=None):
+        if isinstance(images_batch, list):
+            images_batch = torch.stack(images_batch)
 
-        images_batch = torch.stack(images_batch)
+        # decoder embeds token indices itself
+        transcriptions = torch.as_tensor(transcriptions_batch, dtype=torch.long)
+        transcriptions_input = transcriptions[:, :-1]
+        transcriptions_target = transcriptions[:, 1:]
 
-        transcriptions_input = self.eye[transcriptions_batch].unsqueeze(0)[:, :-1]
-        transcriptions_target = torch.LongTensor(transcriptions_batch)[:, 1:]
+        batch_size = len(images_batch)
+        hidden = torch.zeros(1, batch_size, self.hidden_size, device="cpu")
 
-        hidden = torch.zeros(1, 1, self.hidden_size, device="cpu")
-
-        return {
+        batch = {
             "inputs": {
                 "encoder": {
                     "x": images_batch
@@ -69,5 +71,13 @@ class BatchAdapter:
             }
         }
 
+        if image_lengths is not None:
+            batch["inputs"]["encoder"]["x_widths"] = image_lengths
+        if transcription_lengths is not None:
+            # both shifted input and target are one token shorter than a transcription
+            batch["inputs"]["decoder"]["y_lengths"] = transcription_lengths - 1
+            batch["targets"]["y_lengths"] = transcription_lengths - 1
+        return batch
+
     def state_dict(self):
         return dict(alphabet_size=self.alphabet_size, hidden_size=self.hidden_size)
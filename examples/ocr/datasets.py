@@ -6,21 +6,35 @@ from PIL import Image, ImageDraw, ImageFont
 
 
 class DatasetGenerator:
-    def __init__(self, font_size, num_examples, dictionary_path):
+    def __init__(self, font_size, num_examples, dictionary_path, seed=0):
         self.font_size = font_size
         self.num_examples = num_examples
         self.dictionary_path = dictionary_path
 
-    def __iter__(self):
         with open(self.dictionary_path) as f:
             words = f.read().split('\n')
-        random.shuffle(words)
-        return (self.next_example(w) for w in words[:self.num_examples])
+
+        # shuffling is seeded, so that every worker process (and a resumed run) sees the same order
+        random.Random(seed).shuffle(words)
+        self.words = words[:self.num_examples]
+        self.font = None
+
+    def __iter__(self):
+        return (self.next_example(w) for w in self.words)
+
+    def __getitem__(self, idx):
+        return self.next_example(self.words[idx])
+
+    def __len__(self):
+        return len(self.words)
 
     def next_example(self, text):
         padding = 10
 
-        font = ImageFont.truetype("Pillow/Tests/fonts/FreeMono.ttf", self.font_size)
+        if self.font is None:
+            self.font = ImageFont.truetype("Pillow/Tests/fonts/FreeMono.ttf", self.font_size)
+
+        font = self.font
         width, height = font.getsize(text)
         image = Image.new("L", (width + padding, self.font_size + padding), 255)
 
@@ -47,6 +61,18 @@ def save_example(example, output_dir, index):
     image.save(image_path)
 
 
+def save_examples(examples, output_dir, start_index):
+    images_dir = os.path.join(output_dir, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+
+    for index, (image, _) in enumerate(examples, start=start_index):
+        image.save(os.path.join(images_dir, f'{index}.jpg'))
+
+    texts_path = os.path.join(output_dir, 'texts.txt')
+    with open(texts_path, 'a', encoding='utf-8') as f:
+        f.write(''.join(text + '\n' for _, text in examples))
+
+
 class SyntheticDataset(Dataset):
     def __init__(self, path):
         self.path = path
@@ -2,6 +2,8 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+from scaffolding.decoding import GreedySearch
+
 
 class DenseLayer(nn.Module):
     def __init__(self, in_features, mid_features=128, k=32):
@@ -61,14 +63,32 @@ class ImageEncoder(nn.Module):
             nn.BatchNorm2d(256, affine=True)
         )
 
-    def forward(self, x):
+    def forward(self, x, widths=None):
+        """Computes image encodings
+
+        :param x: batch of images
+        :type x: tensor of shape (batch_size, input_channels, height, width)
+        :param widths: widths of images before they were padded
+        :type widths: tensor of shape (batch_size,)
+        :return: a tuple of encodings and a mask telling which of them come from real (not padded) pixels
+        :rtype: (tensor of shape (batch_size, h * w, num_features), bool tensor of shape (batch_size, h * w))
+        """
         output = self.network(x)
         batch_size, f_maps, h, w = output.size()
 
-        return (output.resize(batch_size, f_maps, h * w).transpose(1, 2),)
+        encodings = output.reshape(batch_size, f_maps, h * w).transpose(1, 2)
 
-    def run_inference(self, x):
-        return self.forward(x)
+        if widths is None:
+            return encodings, None
+
+        # both the initial convolution and max pooling have stride 2 and halve the width (rounding up)
+        valid_widths = ((widths.to(output.device) + 1) // 2 + 1) // 2
+        columns = torch.arange(h * w, device=output.device) % w
+        mask = columns.unsqueeze(0) < valid_widths.unsqueeze(1)
+        return encodings, mask
+
+    def run_inference(self, x, widths=None):
+        return self.forward(x, widths)
 
 
 class AttentionNetwork(nn.Module):
@@ -83,83 +103,152 @@ class AttentionNetwork(nn.Module):
         print(embedding_size, hidden_size, embedding_size + hidden_size)
         inner_dim = 32
 
-        self.net = nn.Sequential(
-            nn.Linear(embedding_size + hidden_size, inner_dim),
-            nn.ReLU(),
-            nn.Linear(inner_dim, 1)
-        )
+        # first layer applied to concatenation [encoder_output, hidden] is split into 2 parts,
+        # so that the encoder part can be computed once per image rather than once per decoding step
+        self.encoder_projection = nn.Linear(embedding_size, inner_dim)
+        self.hidden_projection = nn.Linear(hidden_size, inner_dim, bias=False)
+        self.score = nn.Linear(inner_dim, 1)
 
-    def forward(self, decoder_hidden, encoder_outputs):
+    def project_encodings(self, encoder_outputs):
+        """Computes the decoder-independent part of attention scores
+
+        :param encoder_outputs: outputs of the encoder
+        :type encoder_outputs: tensor of shape (batch_size, num_steps, embedding_size)
+        :rtype: tensor of shape (batch_size, num_steps, inner_dim)
+        """
+        return self.encoder_projection(encoder_outputs)
+
+    def forward(self, decoder_hidden, encoder_outputs, mask=None, projected_encodings=None):
         """Computes attention context vectors as a weighted sum of encoder_outputs
 
         :param decoder_hidden: hidden state of the decoder
         :type decoder_hidden: tensor of shape (1, batch_size, num_cells)
         :param encoder_outputs: outputs of the encoder
         :type encoder_outputs: tensor of shape (batch_size, num_steps, embedding_size)
+        :param mask: optional mask, False for padded positions of encoder outputs (they get zero weight)
+        :type mask: bool tensor of shape (batch_size, num_steps)
+        :param projected_encodings: optional result of project_encodings(encoder_outputs)
         :return: context vectors
         :rtype: tensor of shape (batch_size, embedding_size)
         """
+        if projected_encodings is None:
+            projected_encodings = self.project_encodings(encoder_outputs)
 
-        batch_size, num_steps, embedding_size = encoder_outputs.shape
-
-        h = decoder_hidden.squeeze(0).unsqueeze(1).expand(batch_size, num_steps, -1)
+        h = self.hidden_projection(decoder_hidden.squeeze(0)).unsqueeze(1)
 
-        x = torch.cat([encoder_outputs, h], dim=2)
+        scores = self.score(F.relu(projected_encodings + h)).squeeze(2)
 
-        scores = self.net(x)
+        if mask is not None:
+            scores = scores.masked_fill(~mask, float('-inf'))
 
-        weights = F.softmax(scores.squeeze(2), dim=1)
+        weights = F.softmax(scores, dim=1)
         return torch.bmm(weights.unsqueeze(1), encoder_outputs).squeeze(1)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the first layer was split keep it under "net.0"
+        old_weight = state_dict.pop(prefix + 'net.0.weight', None)
+        if old_weight is not None:
+            embedding_size = self.encoder_projection.in_features
+            state_dict[prefix + 'encoder_projection.weight'] = old_weight[:, :embedding_size]
+            state_dict[prefix + 'hidden_projection.weight'] = old_weight[:, embedding_size:]
+            state_dict[prefix + 'encoder_projection.bias'] = state_dict.pop(prefix + 'net.0.bias')
+            state_dict[prefix + 'score.weight'] = state_dict.pop(prefix + 'net.2.weight')
+            state_dict[prefix + 'score.bias'] = state_dict.pop(prefix + 'net.2.bias')
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class AttendingDecoder(nn.Module):
-    def __init__(self, context_size=1024, y_size=128, hidden_size=512, inner_dim=128):
+    def __init__(self, context_size=1024, y_size=128, hidden_size=512, inner_dim=128, embedding_size=None):
         super().__init__()
 
+        embedding_size = embedding_size or y_size
+
         self.y_size = y_size
         self.instance_params = dict(context_size=context_size, y_size=y_size,
-                                    hidden_size=hidden_size, inner_dim=inner_dim)
+                                    hidden_size=hidden_size, inner_dim=inner_dim, embedding_size=embedding_size)
 
         self.hidden_size = hidden_size
 
+        self.embedding = nn.Embedding(y_size, embedding_size)
         self.attention = AttentionNetwork(context_size, hidden_size)
-        self.decoder_gru = nn.GRU(context_size + y_size, hidden_size, batch_first=True)
+        self.decoder_gru = nn.GRU(context_size + embedding_size, hidden_size, batch_first=True)
 
         self.linear = nn.Linear(hidden_size, y_size)
 
-    def forward(self, encodings, decoder_hidden, y_shifted):
-        batch_size, num_steps, num_classes = y_shifted.size()
+        # can be replaced (e.g. with BeamSearch) by "decoding" section of inference config
+        self.search = GreedySearch(eos=2, max_length=40)
 
-        outputs = []
+    def forward(self, encodings, decoder_hidden, y_shifted, encodings_mask=None, lengths=None):
+        """Computes scores for every step of teacher-forced decoding
 
-        for t in range(0, num_steps):
-            y_hat_prev = y_shifted[:, t, :]
-            log_pmf, decoder_hidden = self.predict_next(decoder_hidden, encodings, y_hat_prev)
-            outputs.append(log_pmf)
+        :param y_shifted: indices of previous tokens
+        :type y_shifted: long tensor of shape (batch_size, num_steps)
+        :param lengths: optional lengths of target sequences; steps past the end of
+        a sequence are not computed and get zero scores
+        :type lengths: tensor of shape (batch_size,)
+        """
+        batch_size, num_steps = y_shifted.size()
 
-        y_hat = torch.stack(outputs, dim=1)
-        return [y_hat]
+        if lengths is None:
+            lengths = torch.full((batch_size,), num_steps, dtype=torch.long)
+
+        # sequences are sorted by length, so that the ones still being decoded always come first
+        lengths, order = lengths.cpu().sort(descending=True)
+        order = order.to(encodings.device)
+        encodings = encodings[order]
+        decoder_hidden = decoder_hidden[:, order]
+        y_shifted = y_shifted[order]
+        if encodings_mask is not None:
+            encodings_mask = encodings_mask[order]
+
+        embedded = self.embedding(y_shifted)
+        projected_encodings = self.attention.project_encodings(encodings)
 
-    def run_inference(self, encodings, decoder_hidden, sos):
         outputs = []
 
-        y_hat_prev = sos
+        for t in range(0, num_steps):
+            num_active = int((lengths > t).sum())
+            if num_active == 0:
+                outputs.append(encodings.new_zeros(batch_size, self.y_size))
+                continue
+
+            y_hat_prev = embedded[:num_active, t]
+            mask = encodings_mask[:num_active] if encodings_mask is not None else None
+            log_pmf, hidden = self.predict_next(decoder_hidden[:, :num_active], encodings[:num_active],
+                                                y_hat_prev, mask, projected_encodings[:num_active])
+            outputs.append(F.pad(log_pmf, (0, 0, 0, batch_size - num_active)))
+            decoder_hidden = torch.cat([hidden, decoder_hidden[:, num_active:]], dim=1)
 
-        for t in range(40):
-            scores, decoder_hidden = self.predict_next(decoder_hidden, encodings, y_hat_prev)
+        y_hat = torch.stack(outputs, dim=1)
+        return [y_hat[order.argsort()]]
 
-            top = scores[0].argmax()
+    def run_inference(self, encodings, decoder_hidden, sos, encodings_mask=None):
+        def step(tokens, state):
+            hidden, encoder_outputs, projected, mask = state
+            scores, hidden = self.predict_next(hidden, encoder_outputs, self.embedding(tokens), mask, projected)
+            return scores, (hidden, encoder_outputs, projected, mask)
 
-            y_hat_prev = torch.zeros(1, self.y_size)
-            y_hat_prev[0, top] = 1.0
-            outputs.append(top)
+        projected_encodings = self.attention.project_encodings(encodings)
+        state = (decoder_hidden, encodings, projected_encodings, encodings_mask)
+        outputs = self.search(step, sos, state, batch_dims=(1, 0, 0, 0))
         return [outputs]
 
-    def predict_next(self, decoder_hidden, encoder_outputs, y_hat_prev):
-        c = self.attention(decoder_hidden, encoder_outputs)
+    def predict_next(self, decoder_hidden, encoder_outputs, y_hat_prev, encodings_mask=None,
+                     projected_encodings=None):
+        c = self.attention(decoder_hidden, encoder_outputs, encodings_mask, projected_encodings)
 
         v = torch.cat([y_hat_prev, c], dim=1).unsqueeze(1)
 
         h, hidden = self.decoder_gru(v, decoder_hidden)
         h = h.squeeze(1)
         return self.linear(h), hidden
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the embedding was introduced were trained on one-hot inputs,
+        # an identity embedding reproduces them exactly
+        embedding_key = prefix + 'embedding.weight'
+        if embedding_key not in state_dict and self.embedding.embedding_dim == self.y_size:
+            state_dict[embedding_key] = torch.eye(self.y_size)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
@@ -3,7 +3,8 @@ class PostProcessor:
         self.decoder = data_pipeline.preprocessors[1]
 
     def __call__(self, predictions_dict):
-        return {k: self.to_text(v) for k, v in predictions_dict.items()}
+        # every prediction is a batch of decoded token lists
+        return {k: [self.to_text(tokens) for tokens in v] for k, v in predictions_dict.items()}
 
     def to_text(self, tokens):
         output = tokens
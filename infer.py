@@ -39,6 +39,12 @@ def override_from_config(prediction_pipeline, config):
         node.inputs = config["model"][i]["inputs"]
         node.outputs = config["model"][i]["outputs"]
 
+        decoding_config = config["model"][i].get("decoding")
+        if decoding_config:
+            node.net.instance.search = instantiate_class(
+                decoding_config["class"], *decoding_config.get("args", []), **decoding_config.get("kwargs", {})
+            )
+
     batch_adapter_config = config.get("batch_adapter")
     if batch_adapter_config:
         prediction_pipeline.batch_adapter = build_generic_serializable_instance(batch_adapter_config)
@@ -80,7 +86,9 @@ if __name__ == '__main__':
 
     with torch.no_grad():
         inputs, _ = prediction_pipeline.adapt_batch(batch)
-        outputs = prediction_pipeline(inputs, inference_mode=True)
+        outputs = prediction_pipeline(inputs, inference_mode=True, required_outputs=outputs_keys)
+
+    session.save_compile_cache(prediction_pipeline)
 
     predictions = {k: outputs[k] for k in outputs_keys}
 
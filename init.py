@@ -10,6 +10,10 @@ from scaffolding import parse
 from scaffolding.utils import load_session, save_data_pipeline, load_data_pipeline, change_model_device, \
     instantiate_class, save_session, load_session_from_last_epoch
 from scaffolding.adapters import DefaultAdapter
+from scaffolding.tuning import autotune_loader_params, autotune_cache_path
+from scaffolding.compilation import compile_nodes, save_compile_cache
+from scaffolding.checkpoints import CheckpointWriter, CheckpointCatalog, checkpoint_dicts, read_progress, \
+    write_checkpoint, recover_interrupted_writes
 
 
 def load_config(path):
@@ -41,6 +45,7 @@ class TrainingSession:
         self.data_pipeline_path = os.path.join(path, 'data_pipeline.json')
         self.batch_adapter_path = os.path.join(path, 'batch_adapter.json')
         self.extra_params_path = os.path.join(path, 'extra_params.json')
+        self.compile_cache_dir = os.path.join(path, 'compile_cache')
 
         self.data_pipeline = load_data_pipeline(self.data_pipeline_path)
 
@@ -50,6 +55,19 @@ class TrainingSession:
         self.extra_params = load_json(self.extra_params_path)
         self.device = torch.device(self.extra_params["device"])
         self.num_epochs = self.extra_params["num_epochs"]
+        self.mode = self.extra_params.get("mode", "normal")
+        self.num_processes = self.extra_params.get("num_processes", 1)
+        self.pipeline_parallel = self.extra_params.get("pipeline_parallel", {})
+        self.accumulation_steps = self.extra_params.get("accumulation_steps", 1)
+        self.precision = self.extra_params.get("precision", "fp32")
+
+        self.async_checkpoints = self.extra_params.get("async_checkpoints", False)
+        self.deduplicate_checkpoints = self.extra_params.get("deduplicate_checkpoints", False)
+        self.retention = self.extra_params.get("retention")
+        self.mid_epoch_checkpoints = self.extra_params.get("mid_epoch_checkpoints")
+        self.partial_checkpoints_dir = os.path.join(self.checkpoints_dir, 'partial')
+        self.checkpoint_writer = None
+        self.catalog = CheckpointCatalog(self.checkpoints_dir)
 
         metrics_dict = self.extra_params.get("metrics", {})
         self.metrics = parse.parse_metrics(metrics_dict, self.data_pipeline, self.device)
@@ -59,25 +77,87 @@ class TrainingSession:
 
     @property
     def epochs_trained(self):
-        _, dir_names, _ = next(os.walk(self.checkpoints_dir))
-        # first checkpoint is for untrained model, therefore we subtract it
-        return len(dir_names) - 1
-
-    def restore_from_last_checkpoint(self, inference_mode=False):
-        model = load_session_from_last_epoch(self.checkpoints_dir, self.device, inference_mode)
+        # first checkpoint is for untrained model (epoch 0), older ones may be removed by retention
+        return self.catalog.latest()
+
+    def prepare_checkpoints(self):
+        """Recovers from checkpoint writes interrupted by a crash and builds the catalog of sessions
+        created before catalogs existed (to be called by the main process before training)
+        """
+        recover_interrupted_writes(self.checkpoints_dir)
+        recover_interrupted_writes(self.partial_checkpoints_dir)
+        self.catalog.ensure()
+
+    def mid_epoch_progress(self):
+        """Returns progress saved by the last mid-epoch checkpoint of the epoch following the last
+        finished one or None (see make_mid_epoch_checkpoint)
+        """
+        epoch = self.epochs_trained + 1
+        progress = read_progress(self.partial_checkpoints_dir, epoch)
+        if progress is None or progress["epoch"] != epoch:
+            return None
+        return progress
+
+    def restore_from_last_checkpoint(self, inference_mode=False, resume=False):
+        """
+        :param resume: whether to load a mid-epoch checkpoint of an unfinished epoch when there is one,
+        only training sets it, others get the last completed epoch
+        """
+        progress = self.mid_epoch_progress() if resume else None
+        if progress:
+            # training gets resumed in the middle of an unfinished epoch
+            model = load_session(self.partial_checkpoints_dir, progress["epoch"], self.device)
+        else:
+            model = load_session_from_last_epoch(self.checkpoints_dir, self.device, inference_mode)
         change_model_device(model, self.data_pipeline.device_str)
+        compile_nodes(model, self.compile_cache_dir)
 
-        train_pipeline = PredictionPipeline(model, self.device, self.batch_adapter)
+        train_pipeline = PredictionPipeline(model, self.device, self.batch_adapter, self.precision)
 
         return train_pipeline
 
     def make_checkpoint(self, train_pipeline, epoch):
-        save_session(train_pipeline, epoch, self.checkpoints_dir)
+        # in hogwild mode a writer thread would be running while workers get forked
+        if self.async_checkpoints and self.mode != "hogwild":
+            if self.checkpoint_writer is None:
+                self.checkpoint_writer = CheckpointWriter()
+            self.checkpoint_writer.submit(self.checkpoints_dir, epoch, checkpoint_dicts(train_pipeline, epoch),
+                                          self.deduplicate_checkpoints, self.retention)
+        else:
+            save_session(train_pipeline, epoch, self.checkpoints_dir, self.deduplicate_checkpoints, self.retention)
+
+        self.save_compile_cache(train_pipeline)
+
+    def make_mid_epoch_checkpoint(self, train_pipeline, epoch, progress):
+        """Saves state of an unfinished epoch, only the latest such checkpoint is kept
+
+        :param progress: a dictionary with "epoch", "iteration" (number of batches done) and
+        "rng_states" (states of random number generators, see get_rng_states)
+        """
+        dicts = checkpoint_dicts(train_pipeline, epoch)
+        retention = {"keep_last": 1}
+        if self.async_checkpoints:
+            if self.checkpoint_writer is None:
+                self.checkpoint_writer = CheckpointWriter()
+            self.checkpoint_writer.submit(self.partial_checkpoints_dir, epoch, dicts,
+                                          self.deduplicate_checkpoints, retention, progress)
+        else:
+            write_checkpoint(self.partial_checkpoints_dir, epoch, dicts,
+                             self.deduplicate_checkpoints, retention, progress)
+
+    def wait_for_checkpoints(self):
+        if self.checkpoint_writer:
+            self.checkpoint_writer.wait()
+
+    def save_compile_cache(self, prediction_pipeline):
+        if any(node.compiled for node in prediction_pipeline):
+            save_compile_cache(self.compile_cache_dir)
 
     def log_metrics(self, epoch, train_metrics, val_metrics):
         # todo: log metrics to csv file
         history = TrainingHistory(self.history_path)
-        history.add_entry(epoch, train_metrics, val_metrics)
+        row = history.add_entry(epoch, train_metrics, val_metrics)
+        self.catalog.record_metrics(epoch, {k: v for k, v in row.items() if k != 'epoch'})
 
     @classmethod
     def create_session(cls, config, save_path):
@@ -92,20 +172,36 @@ class TrainingSession:
         epochs = parse.parse_epochs(config)
 
         data_pipeline = parse.DataPipeline.create(config)
-        save_data_pipeline(data_pipeline, data_pipeline_path)
+
+        deduplicate_checkpoints = config["training"].get("deduplicate_checkpoints", True)
 
         model = parse.parse_model(config)
         change_model_device(model, data_pipeline.device_str)
-        save_session(model, 0, checkpoints_dir)
+        save_session(model, 0, checkpoints_dir, deduplicate_checkpoints)
 
         batch_adapter = parse_adapter(config["training"].get("batch_adapter"))
         save_as_json(batch_adapter.to_dict(), batch_adapter_path)
 
+        autotune_config = config["data"].get("loader", {}).get("autotune")
+        if autotune_config:
+            cache_path = autotune_cache_path(os.path.dirname(os.path.abspath(save_path)), config["data"])
+            autotune_loader_params(data_pipeline, batch_adapter, autotune_config, cache_path)
+
+        save_data_pipeline(data_pipeline, data_pipeline_path)
+
         extra_params = {}
 
         training_config = config["training"]
 
         extra_params["device"] = training_config.get("device", "cpu")
+        extra_params["mode"], extra_params["num_processes"] = parse.parse_training_mode(training_config)
+        extra_params["pipeline_parallel"] = parse.parse_pipeline_parallel(training_config)
+        extra_params["accumulation_steps"] = parse.parse_accumulation_steps(training_config)
+        extra_params["precision"] = parse.parse_precision(training_config)
+        extra_params["async_checkpoints"] = training_config.get("async_checkpoints", False)
+        extra_params["deduplicate_checkpoints"] = deduplicate_checkpoints
+        extra_params["retention"] = parse.parse_retention(training_config)
+        extra_params["mid_epoch_checkpoints"] = parse.parse_mid_epoch_checkpoints(training_config)
 
         if "loss" in training_config:
             extra_params["loss"] = training_config["loss"]
@@ -143,6 +239,7 @@ class TrainingHistory:
             fieldnames = list(row_dict.keys())
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writerow(row_dict)
+        return row_dict
 
     def scalar(self, t):
         return t.item() if hasattr(t, 'item') else t
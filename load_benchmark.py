@@ -0,0 +1,50 @@
+import argparse
+import multiprocessing
+import time
+
+from scaffolding.checkpoints import is_mmap_supported
+from scaffolding.memory import peak_memory, resident_memory, format_memory
+from init import TrainingSession
+
+
+def measure(session_path, inference_mode, results):
+    """Restores the last checkpoint of a session in a fresh process, reports (seconds, resident, peak memory)"""
+    t0 = time.perf_counter()
+    session = TrainingSession(session_path)
+    session.restore_from_last_checkpoint(inference_mode=inference_mode)
+    elapsed = time.perf_counter() - t0
+    results.put((elapsed, resident_memory(), peak_memory()))
+
+
+def run(session_path, inference_mode):
+    # every run starts a new interpreter, so that neither memory nor imported modules are shared between runs
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=measure, args=(session_path, inference_mode, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare cold start time and memory of loading the last checkpoint for training and for inference'
+    )
+    parser.add_argument('session_path', type=str, help='Path to the session directory')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of loads per mode, the fastest one is reported')
+
+    cmd_args = parser.parse_args()
+
+    session = TrainingSession(cmd_args.session_path)
+    entry = session.catalog.entry(session.epochs_trained)
+    if "nodes" in entry:
+        print(f'Epoch {entry["epoch"]}, {len(entry["nodes"])} nodes, {format_memory(entry["size"])} on disk')
+    if not is_mmap_supported():
+        print('torch.load does not support mmap in this version of PyTorch, inference load reads files fully')
+
+    print(f'{"":12} {"seconds":>10} {"resident":>12} {"peak":>12}')
+    for name, inference_mode in [('training', False), ('inference', True)]:
+        runs = [run(cmd_args.session_path, inference_mode) for _ in range(cmd_args.repeats)]
+        seconds, resident, peak = min(runs, key=lambda r: r[0])
+        print(f'{name:12} {seconds:10.3f} {format_memory(resident):>12} {format_memory(peak):>12}')
@@ -0,0 +1,41 @@
+import argparse
+import os
+
+from scaffolding import parse
+from scaffolding.exceptions import InvalidParameterError
+from scaffolding.shards import convert_to_shards
+from scaffolding.utils import instantiate_class
+from train import load_config
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a dataset specified in a training configuration file into packed shards'
+    )
+    parser.add_argument('config', type=str, help='Path to the training configuration file')
+    parser.add_argument('output_dir', type=str, help='Directory to save shards to')
+    parser.add_argument('--shard_size', type=int, default=256, help='Size of a single shard in megabytes')
+
+    cmd_args = parser.parse_args()
+
+    config = load_config(cmd_args.config)
+    data_config = config["pipeline"]["data"]
+
+    ds_class_name = data_config["dataset_name"]
+    if '.' not in ds_class_name:
+        raise InvalidParameterError(
+            f'Dataset "{ds_class_name}" is a built-in torchvision dataset which is already stored in packed files. '
+            f'Only custom datasets (given by a fully-qualified class name) can be converted'
+        )
+
+    if os.path.exists(cmd_args.output_dir):
+        print(f"Shards already exist under {cmd_args.output_dir}")
+    else:
+        parse.generate_data(data_config)
+        ds_args = data_config.get("dataset_args", [])
+        ds_kwargs = data_config.get("dataset_kwargs", {})
+        dataset = instantiate_class(ds_class_name, *ds_args, **ds_kwargs)
+        convert_to_shards(dataset, cmd_args.output_dir, shard_size=cmd_args.shard_size * 2 ** 20)
+
+        print(f'Converted {len(dataset)} examples. To use them, set "dataset_name" to '
+              f'"scaffolding.shards.ShardedDataset" and "dataset_kwargs" to {{"path": "{cmd_args.output_dir}"}}')
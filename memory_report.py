@@ -0,0 +1,75 @@
+import argparse
+import multiprocessing
+import time
+
+from scaffolding.training import Trainer
+from scaffolding.utils import switch_to_train_mode
+from scaffolding.activation_checkpointing import disable_activation_checkpointing
+from scaffolding.memory import reset_peak_memory, peak_memory, format_memory
+from init import TrainingSession
+
+
+def measure(session_path, num_batches, checkpointing, results):
+    """Runs training iterations over num_batches batches with or without activation checkpointing,
+    reports (peak memory in bytes, seconds per iteration)
+    """
+    session = TrainingSession(session_path)
+    train_pipeline = session.restore_from_last_checkpoint()
+    train_loader, _ = session.data_pipeline.get_data_loaders(train_pipeline.batch_adapter)
+
+    batches = []
+    for batch in train_loader:
+        if len(batches) >= num_batches:
+            break
+        batches.append(train_pipeline.adapt_batch(batch))
+
+    # weights are updated in memory only, the session is left intact
+    trainer = Trainer(train_loader, train_pipeline, session.criterion)
+    switch_to_train_mode(train_pipeline)
+
+    if not checkpointing:
+        for node in train_pipeline:
+            disable_activation_checkpointing(node.net.instance)
+
+    reset_peak_memory()
+    t0 = time.perf_counter()
+    for inputs, targets in batches:
+        trainer.train_on_batch(inputs, targets)
+    elapsed = time.perf_counter() - t0
+    results.put((peak_memory(), elapsed / max(1, len(batches))))
+
+
+def run(session_path, num_batches, checkpointing):
+    # every configuration runs in a new interpreter, so that its peak is not floored by memory left from another one
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=measure, args=(session_path, num_batches, checkpointing, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare peak memory and speed of training with and without activation checkpointing'
+    )
+    parser.add_argument('session_path', type=str, help='Path to the session directory')
+    parser.add_argument('--num_batches', type=int, default=10, help='Number of training iterations per run')
+
+    cmd_args = parser.parse_args()
+
+    session = TrainingSession(cmd_args.session_path)
+    checkpointed = [node.name for node in session.restore_from_last_checkpoint(inference_mode=True)
+                    if node.activation_checkpointing]
+    if not checkpointed:
+        print('None of the nodes has "activation_checkpointing" option, measuring baseline only')
+
+    baseline_peak, baseline_time = run(cmd_args.session_path, cmd_args.num_batches, checkpointing=False)
+
+    print(f'{"":26} {"peak memory":>12} {"s/iteration":>12}')
+    print(f'{"without checkpointing":26} {format_memory(baseline_peak):>12} {baseline_time:12.3f}')
+
+    if checkpointed:
+        peak, seconds = run(cmd_args.session_path, cmd_args.num_batches, checkpointing=True)
+        print(f'{"with checkpointing":26} {format_memory(peak):>12} {seconds:12.3f}')
@@ -0,0 +1,103 @@
+import inspect
+
+import torch
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+
+from scaffolding.exceptions import InvalidParameterError
+
+
+def selected_submodules(module, options):
+    """Returns names of submodules chosen by activation checkpointing options
+
+    :param module: model of a node
+    :param options: a dictionary returned by parse_activation_checkpointing
+    """
+    if "modules" in options:
+        return list(options["modules"])
+
+    container_name = options.get("container", "")
+    container = module.get_submodule(container_name)
+    prefix = f'{container_name}.' if container_name else ''
+
+    every = options["every"]
+    return [f'{prefix}{name}' for i, (name, _) in enumerate(container.named_children()) if i % every == 0]
+
+
+def has_running_stats(module):
+    """Tells whether a module or any of its submodules updates running statistics in training mode (e.g. BatchNorm)"""
+    return any(isinstance(m, _BatchNorm) and m.track_running_stats for m in module.modules())
+
+
+def enable_activation_checkpointing(module, options):
+    """Makes selected submodules recompute their activations during backward pass instead of storing them
+
+    Forward method of every selected submodule gets replaced on the instance, so the class and
+    the state_dict of the model stay the same. Submodules updating running statistics (e.g. BatchNorm)
+    are excluded, since recomputation would update them twice per batch. Naming such a submodule
+    in "modules" is an error, when selected by "every" it is skipped.
+
+    :return: a list of names of submodules that got checkpointed
+    """
+    names = []
+    for name in selected_submodules(module, options):
+        submodule = module.get_submodule(name)
+        if has_running_stats(submodule):
+            if "modules" in options:
+                raise InvalidParameterError(
+                    f'Submodule "{name}" can not be checkpointed: it updates running statistics (e.g. BatchNorm), '
+                    f'which would be updated twice'
+                )
+            continue
+
+        if 'forward' not in submodule.__dict__:
+            submodule.forward = checkpointed(submodule.forward)
+        names.append(name)
+    return names
+
+
+def disable_activation_checkpointing(module):
+    for submodule in module.modules():
+        submodule.__dict__.pop('forward', None)
+
+
+def checkpointed(forward):
+    def checkpointed_forward(*args):
+        if not torch.is_grad_enabled():
+            return forward(*args)
+
+        kwargs = checkpoint_kwargs()
+        if not kwargs:
+            checkpoint_args = reentrant_args(args)
+            if checkpoint_args is None:
+                # parameters would get no gradients, activations are stored as usual instead
+                return forward(*args)
+            args = checkpoint_args
+        return checkpoint(forward, *args, **kwargs)
+    return checkpointed_forward
+
+
+def reentrant_args(args):
+    """Makes arguments suitable for reentrant checkpointing, returns None when they can not be
+
+    Reentrant implementation only computes gradients of parameters when some input requires grad.
+    Inputs that do not (e.g. outputs of a frozen node) are replaced by a detached copy requiring grad.
+    None is returned when there are no floating point tensors among arguments (e.g. token ids only).
+    """
+    tensors = [arg for arg in args if isinstance(arg, torch.Tensor)]
+    if any(t.requires_grad for t in tensors):
+        return args
+
+    floating = [t for t in tensors if t.is_floating_point()]
+    if not floating:
+        return None
+
+    first = floating[0]
+    return tuple(arg.detach().requires_grad_() if arg is first else arg for arg in args)
+
+
+def checkpoint_kwargs():
+    # older versions only have reentrant implementation (see reentrant_args)
+    if 'use_reentrant' in inspect.signature(checkpoint).parameters:
+        return {'use_reentrant': False}
+    return {}
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import shutil
+import socket
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from scaffolding.codecs import encode_value, decode_value, stored_length
+from scaffolding.collators import pad_tensors
+from scaffolding.exceptions import TrainingError
+
+
+class CachedDataset(Dataset):
+    """Dataset of preprocessed examples stored in a memory-mapped file
+
+    Every element of every example is stored as raw bytes in a single data file,
+    while an index keeps their offsets, sizes, data types and shapes.
+    """
+    data_file = 'data.bin'
+    index_file = 'index.pt'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index = torch.load(os.path.join(cache_dir, self.index_file))
+        self.data = None
+
+    def __getitem__(self, idx):
+        if self.data is None:
+            # opened lazily, so that every DataLoader worker maps the file on its own
+            self.data = open_data_file(os.path.join(self.cache_dir, self.data_file))
+
+        return [decode_value(self.data[offset:offset + num_bytes], kind, dtype, shape)
+                for kind, offset, num_bytes, dtype, shape in self.index[idx]]
+
+    def __len__(self):
+        return len(self.index)
+
+    def lengths(self, length_index=0, length_dim=-1):
+        """Returns lengths of a given element of all examples, reading only the index when possible"""
+        from scaffolding.samplers import example_length
+
+        lengths = []
+        for idx, records in enumerate(self.index):
+            kind, _, _, _, shape = records[length_index]
+            length = stored_length(kind, shape, length_dim)
+            lengths.append(example_length(self[idx][length_index], length_dim) if length is None else length)
+        return lengths
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    @classmethod
+    def build(cls, dataset, cache_dir, num_workers=0):
+        """Runs every example of a dataset through preprocessors and stores results under cache_dir
+
+        Files are written to a temporary directory of the process first, so that an interrupted run never
+        leaves a partially built cache behind and processes building the same cache do not collide.
+        """
+        tmp_dir = f'{cache_dir}.tmp.{socket.gethostname()}.{os.getpid()}'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers,
+                                             collate_fn=keep_as_is)
+        index = []
+        offset = 0
+        with open(os.path.join(tmp_dir, cls.data_file), 'wb') as f:
+            for example in loader:
+                records = []
+                for value in example:
+                    kind, dtype, shape, data = encode_value(value)
+                    f.write(data)
+                    records.append((kind, offset, len(data), dtype, shape))
+                    offset += len(data)
+                index.append(records)
+
+        torch.save(index, os.path.join(tmp_dir, cls.index_file))
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+            # another process has built the same cache in the meantime
+            shutil.rmtree(tmp_dir)
+        return cls(cache_dir)
+
+
+class FeatureCache:
+    """Outputs of a frozen node stored per example in a memory-mapped file
+
+    Every output of a node is split along its batch dimension and the part of every example is stored
+    under its dataset index. A batch is reassembled from stored parts by padding them to a common shape.
+    Values that are not tensors are stored as they are and collected into lists.
+    Cached outputs are only valid when examples are the same on every epoch (no random augmentation).
+    """
+    data_file = 'data.bin'
+    index_file = 'index.pt'
+
+    def __init__(self, cache_dir, batch_dims=None):
+        """
+        :param cache_dir: directory to store outputs in
+        :param batch_dims: a list with the batch dimension of every output (0 for all of them by default)
+        """
+        self.cache_dir = cache_dir
+        self.batch_dims = batch_dims
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.data_path = os.path.join(cache_dir, self.data_file)
+        self.index_path = os.path.join(cache_dir, self.index_file)
+
+        self.index = torch.load(self.index_path) if os.path.exists(self.index_path) else {}
+
+        # bytes past the last offset recorded in the index are left from an interrupted run
+        size = max((offset + num_bytes for records in self.index.values()
+                    for _, offset, num_bytes, _, _ in records), default=0)
+        with open(self.data_path, 'ab') as f:
+            f.truncate(size)
+
+        self.size = size
+        self.writer = None
+        self.data = None
+
+    def get(self, indices):
+        """Returns a list of outputs for a batch of examples or None when some of them are not cached yet"""
+        indices = [int(i) for i in indices]
+        if not all(i in self.index for i in indices):
+            return None
+
+        if self.data is None or len(self.data) < self.size:
+            if self.writer:
+                self.writer.flush()
+            self.data = open_data_file(self.data_path)
+
+        columns = zip(*[[decode_value(self.data[offset:offset + num_bytes], kind, dtype, shape)
+                         for kind, offset, num_bytes, dtype, shape in self.index[i]] for i in indices])
+        return [pad_tensors(list(column)).movedim(0, self.batch_dim(position))
+                if isinstance(column[0], torch.Tensor) else list(column)
+                for position, column in enumerate(columns)]
+
+    def put(self, indices, outputs):
+        """Stores outputs computed for a batch of examples with given dataset indices (skipping cached ones)"""
+        if any(value is None for value in outputs):
+            raise TrainingError('Outputs of a node caching them must not be None')
+
+        if self.writer is None:
+            self.writer = open(self.data_path, 'ab')
+
+        for position, idx in enumerate(indices):
+            if int(idx) in self.index:
+                # a batch may be partly cached already (e.g. after reshuffling)
+                continue
+
+            records = []
+            for i, value in enumerate(outputs):
+                if isinstance(value, torch.Tensor):
+                    value = value.select(self.batch_dim(i), position)
+                else:
+                    value = value[position]
+                kind, dtype, shape, data = encode_value(value)
+                self.writer.write(data)
+                records.append((kind, self.size, len(data), dtype, shape))
+                self.size += len(data)
+            self.index[int(idx)] = records
+
+    def batch_dim(self, output_index):
+        return self.batch_dims[output_index] if self.batch_dims else 0
+
+    def flush(self):
+        """Makes cached outputs persistent, so that they are reused when training is resumed"""
+        if self.writer:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+
+        tmp_path = f'{self.index_path}.tmp'
+        torch.save(self.index, tmp_path)
+        os.replace(tmp_path, self.index_path)
+
+
+def keep_as_is(example):
+    return example
+
+
+def example_cache_key(dataset_identity, preprocessors):
+    """Computes a hash of dataset identity and states of all preprocessors
+
+    Any change to preprocessors state (e.g. refitting them on a new vocabulary) produces a new key.
+    """
+    d = {
+        'dataset': dataset_identity,
+        'preprocessors': [p.to_dict() for p in preprocessors]
+    }
+    s = json.dumps(d, sort_keys=True, default=value_digest)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()[:32]
+
+
+def value_digest(value):
+    """Describes a value which is not JSON serializable (e.g. a tensor) by a hash of its raw bytes,
+    since its repr may be truncated
+    """
+    kind, dtype, shape, data = encode_value(value)
+    return {'kind': kind, 'dtype': dtype, 'shape': list(shape) if shape else shape,
+            'sha256': hashlib.sha256(data).hexdigest()}
+
+
+def open_data_file(path):
+    if os.path.getsize(path) == 0:
+        # numpy refuses to map empty files
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
@@ -0,0 +1,490 @@
+import atexit
+import hashlib
+import inspect
+import json
+import os
+import time
+import queue
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+from scaffolding.codecs import encode_value, decode_value
+
+
+blobs_dir_name = 'blobs'
+
+# smaller tensors are kept inside manifests
+min_blob_size = 4096
+
+catalog_file_name = 'catalog.json'
+
+# training progress saved along with a mid-epoch checkpoint
+progress_file_name = 'progress'
+
+# state of the optimizer of a node is kept in its own file, so that inference never reads it
+optimizer_file_suffix = '.optimizer'
+
+# catalog is updated both by the training loop (metrics) and by a background checkpoint writer
+catalog_lock = threading.Lock()
+
+
+def epoch_numbers(checkpoints_dir):
+    """Returns sorted numbers of epochs that have checkpoints (temporary and other directories are ignored)"""
+    return sorted(int(name) for name in os.listdir(checkpoints_dir)
+                  if name.isdigit() and os.path.isdir(os.path.join(checkpoints_dir, name)))
+
+
+def checkpoint_dicts(train_pipeline, epoch):
+    """Returns a dictionary mapping names of nodes to their checkpoints"""
+    dicts = {}
+    for number, pipe in enumerate(train_pipeline, start=1):
+        d = {
+            'name': pipe.name,
+            'number': number,
+            'inputs': pipe.inputs,
+            'outputs': pipe.outputs,
+            'epoch': epoch,
+            'frozen': pipe.frozen,
+            'cache_outputs': pipe.cache_outputs,
+            'compile': pipe.compile_options,
+            'activation_checkpointing': pipe.activation_checkpointing
+        }
+        d.update(pipe.net.to_dict())
+        d.update(pipe.optimizer.to_dict())
+        dicts[pipe.name] = d
+    return dicts
+
+
+def snapshot(obj):
+    """Returns a copy of a (nested) checkpoint with all tensors copied into CPU memory
+
+    The copy is not affected by subsequent training steps, so it can be written in the background.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def write_checkpoint(checkpoints_dir, epoch, dicts, deduplicate=False, retention=None, progress=None):
+    """Writes checkpoints of all nodes into a temporary directory and renames it to the epoch directory
+
+    A checkpoint directory therefore either contains files of all nodes or does not exist at all.
+
+    :param deduplicate: whether to store tensors in a content-addressed BlobStore shared by all epochs,
+    so that files of nodes only keep references to them (manifests)
+    :param retention: optional retention policy (see CheckpointCatalog.apply_retention) applied
+    once the checkpoint is written
+    :param progress: optional position of training within an unfinished epoch (see read_progress),
+    written into the same directory
+    """
+    epoch_dir = os.path.join(checkpoints_dir, str(epoch))
+    tmp_dir = f'{epoch_dir}.tmp'
+
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    store = BlobStore(os.path.join(checkpoints_dir, blobs_dir_name))
+    if deduplicate:
+        dicts = {name: store.deduplicate(d) for name, d in dicts.items()}
+
+    files = {}
+    for name, d in dicts.items():
+        files[name] = {k: v for k, v in d.items() if k != 'optimizer_state_dict'}
+        if 'optimizer_state_dict' in d:
+            files[f'{name}{optimizer_file_suffix}'] = {'optimizer_state_dict': d['optimizer_state_dict']}
+
+    if progress is not None:
+        files[progress_file_name] = progress
+
+    for name, d in files.items():
+        path = os.path.join(tmp_dir, name)
+        with open(path, 'wb') as f:
+            torch.save(d, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    if os.path.exists(epoch_dir):
+        old_dir = f'{epoch_dir}.old'
+        if os.path.exists(old_dir):
+            # left by a run interrupted after the previous checkpoint of the epoch was replaced
+            shutil.rmtree(old_dir)
+        os.replace(epoch_dir, old_dir)
+        os.replace(tmp_dir, epoch_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.replace(tmp_dir, epoch_dir)
+
+    catalog = CheckpointCatalog(checkpoints_dir)
+    catalog.add_epoch(epoch, dicts, store)
+    if retention:
+        catalog.apply_retention(**retention)
+
+
+def recover_interrupted_writes(checkpoints_dir):
+    """Cleans up after write_checkpoint interrupted by a crash
+
+    A checkpoint moved aside to "<epoch>.old" is put back when its replacement never made it
+    to the epoch directory and removed otherwise. Partially written "<epoch>.tmp" directories are removed.
+    """
+    if not os.path.isdir(checkpoints_dir):
+        return
+
+    for name in os.listdir(checkpoints_dir):
+        path = os.path.join(checkpoints_dir, name)
+        stem, extension = os.path.splitext(name)
+        if not stem.isdigit() or not os.path.isdir(path):
+            continue
+
+        epoch_dir = os.path.join(checkpoints_dir, stem)
+        if extension == '.old':
+            if os.path.exists(epoch_dir):
+                shutil.rmtree(path)
+            else:
+                os.replace(path, epoch_dir)
+        elif extension == '.tmp':
+            shutil.rmtree(path)
+
+
+def node_file_names(epoch_dir):
+    """Returns names of checkpoint files of nodes in an epoch directory"""
+    return [name for name in os.listdir(epoch_dir)
+            if name != progress_file_name and not name.endswith(optimizer_file_suffix)]
+
+
+def load_node_files(path):
+    """Loads a checkpoint of a node together with the state of its optimizer kept in a separate file
+    (checkpoints written before it was separated have it in the same file)
+    """
+    checkpoint = torch.load(path)
+    optimizer_path = f'{path}{optimizer_file_suffix}'
+    if os.path.exists(optimizer_path):
+        checkpoint.update(torch.load(optimizer_path))
+    return checkpoint
+
+
+def read_progress(checkpoints_dir, epoch):
+    """Returns progress saved with a checkpoint of an unfinished epoch or None"""
+    path = os.path.join(checkpoints_dir, str(epoch), progress_file_name)
+    if not os.path.exists(path):
+        return None
+
+    # states of random number generators are not plain tensors
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, weights_only=False)
+    return torch.load(path)
+
+
+def is_mmap_supported():
+    return 'mmap' in inspect.signature(torch.load).parameters
+
+
+def read_checkpoint(path, checkpoints_dir, mmap=False, with_optimizer=True):
+    """Loads a checkpoint file of a node, resolving references to blobs if it is a manifest
+
+    :param mmap: whether tensors are memory-mapped from files instead of being read into memory,
+    so that only pages actually used get loaded (when supported by PyTorch)
+    :param with_optimizer: whether state of the optimizer is read; its file is not opened otherwise
+    (older checkpoints keeping it in the same file have it dropped before blobs are read)
+    """
+    if mmap and is_mmap_supported():
+        checkpoint = torch.load(path, map_location='cpu', mmap=True)
+    else:
+        checkpoint = torch.load(path)
+
+    optimizer_path = f'{path}{optimizer_file_suffix}'
+    if with_optimizer and os.path.exists(optimizer_path):
+        checkpoint.update(torch.load(optimizer_path))
+
+    if not with_optimizer:
+        checkpoint.pop('optimizer_state_dict', None)
+    return BlobStore(os.path.join(checkpoints_dir, blobs_dir_name)).resolve(checkpoint, mmap)
+
+
+def is_blob_reference(obj):
+    return isinstance(obj, dict) and '__blob__' in obj
+
+
+class BlobStore:
+    """Content-addressed storage of tensors
+
+    Every tensor is stored in a file named after a hash of its data type and raw bytes,
+    so a tensor that did not change between epochs (e.g. weights of a frozen node) is written only once.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, tensor):
+        """Stores a tensor (unless it is already stored), returns a reference to it"""
+        kind, dtype, shape, data = encode_value(tensor)
+        digest = hashlib.sha256(dtype.encode('utf-8') + data).hexdigest()
+
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+
+        return {'__blob__': digest, 'dtype': dtype, 'shape': shape}
+
+    def get(self, reference, mmap=False):
+        path = self.path(reference['__blob__'])
+        if mmap:
+            return self.map(path, reference['dtype'], reference['shape'])
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        return decode_value(data, 'tensor', reference['dtype'], reference['shape'])
+
+    def map(self, path, dtype, shape):
+        # copy-on-write mapping: pages are read lazily and the blob file is never modified
+        if dtype == 'bfloat16':
+            array = np.memmap(path, dtype=np.int16, mode='c', shape=tuple(shape))
+            return torch.from_numpy(array).view(torch.bfloat16)
+        return torch.from_numpy(np.memmap(path, dtype=np.dtype(dtype), mode='c', shape=tuple(shape)))
+
+    def size(self, digest):
+        return os.path.getsize(self.path(digest))
+
+    def references(self, obj):
+        """Returns a set of digests of blobs referenced by a (nested) checkpoint"""
+        if is_blob_reference(obj):
+            return {obj['__blob__']}
+        values = obj.values() if isinstance(obj, dict) else obj if isinstance(obj, (list, tuple)) else []
+        return set().union(*[self.references(v) for v in values])
+
+    def collect_garbage(self, referenced):
+        """Removes blobs that are not referenced anymore"""
+        if not os.path.isdir(self.root):
+            return
+
+        for dir_name in os.listdir(self.root):
+            for file_name in os.listdir(os.path.join(self.root, dir_name)):
+                if file_name not in referenced:
+                    os.remove(os.path.join(self.root, dir_name, file_name))
+
+    def deduplicate(self, obj):
+        """Returns a copy of a (nested) checkpoint with large tensors replaced by references to stored blobs"""
+        if isinstance(obj, torch.Tensor):
+            if obj.numel() * obj.element_size() < min_blob_size:
+                return obj
+            return self.put(obj)
+        if isinstance(obj, dict):
+            return type(obj)((k, self.deduplicate(v)) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.deduplicate(v) for v in obj)
+        return obj
+
+    def resolve(self, obj, mmap=False):
+        """Reverses deduplicate (checkpoints without references are returned as they are)"""
+        if is_blob_reference(obj):
+            return self.get(obj, mmap)
+        if isinstance(obj, dict):
+            return type(obj)((k, self.resolve(v, mmap)) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.resolve(v, mmap) for v in obj)
+        return obj
+
+
+class CheckpointCatalog:
+    """Index of checkpoints kept in a JSON file next to them
+
+    For every epoch it keeps metadata of nodes (names, order, inputs, outputs), sizes of their files,
+    blobs they reference and metrics of the epoch, so that queries about checkpoints do not open them.
+    Sessions created before the catalog existed get it rebuilt from checkpoint files once by training
+    (see ensure), until then queries fall back to listing epoch directories without writing anything.
+    """
+    def __init__(self, checkpoints_dir):
+        self.checkpoints_dir = checkpoints_dir
+        self.path = os.path.join(checkpoints_dir, catalog_file_name)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            # entries only have epoch numbers, nodes are found by listing epoch directories
+            return {'epochs': {str(epoch): {'epoch': epoch} for epoch in epoch_numbers(self.checkpoints_dir)}}
+
+        with open(self.path, encoding='utf-8') as f:
+            return json.loads(f.read())
+
+    def load_for_update(self):
+        if not os.path.exists(self.path):
+            return self.rebuild()
+        return self.load()
+
+    def ensure(self):
+        """Builds the catalog of a session created before catalogs existed (must be called by one process only)"""
+        if not os.path.exists(self.path):
+            with catalog_lock:
+                self.rebuild()
+
+    def save(self, catalog):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(catalog, indent=2))
+        os.replace(tmp_path, self.path)
+
+    def rebuild(self):
+        store = BlobStore(os.path.join(self.checkpoints_dir, blobs_dir_name))
+        catalog = {'epochs': {}}
+        for epoch in epoch_numbers(self.checkpoints_dir):
+            epoch_dir = os.path.join(self.checkpoints_dir, str(epoch))
+            dicts = {name: load_node_files(os.path.join(epoch_dir, name)) for name in node_file_names(epoch_dir)}
+            catalog['epochs'][str(epoch)] = self.make_entry(epoch, dicts, store)
+        self.save(catalog)
+        return catalog
+
+    def make_entry(self, epoch, dicts, store):
+        epoch_dir = os.path.join(self.checkpoints_dir, str(epoch))
+
+        nodes = []
+        blobs = set()
+        for name, d in dicts.items():
+            references = store.references(d)
+            blobs.update(references)
+
+            path = os.path.join(epoch_dir, name)
+            size = os.path.getsize(path) + sum(store.size(r) for r in references)
+            if os.path.exists(f'{path}{optimizer_file_suffix}'):
+                size += os.path.getsize(f'{path}{optimizer_file_suffix}')
+
+            nodes.append({
+                'name': name,
+                'number': d['number'],
+                'inputs': d['inputs'],
+                'outputs': d['outputs'],
+                'size': size
+            })
+
+        nodes.sort(key=lambda node: node['number'])
+        return {
+            'epoch': epoch,
+            'time': time.time(),
+            'nodes': nodes,
+            'size': sum(node['size'] for node in nodes),
+            'blobs': sorted(blobs)
+        }
+
+    def add_epoch(self, epoch, dicts, store):
+        with catalog_lock:
+            catalog = self.load_for_update()
+            entry = self.make_entry(epoch, dicts, store)
+            entry['metrics'] = catalog.get('metrics', {}).get(str(epoch), {})
+            catalog['epochs'][str(epoch)] = entry
+            self.save(catalog)
+
+    def record_metrics(self, epoch, metrics):
+        """Stores metrics of an epoch (e.g. {"val loss": 0.5}), they may arrive before its checkpoint"""
+        with catalog_lock:
+            catalog = self.load_for_update()
+            catalog.setdefault('metrics', {})[str(epoch)] = metrics
+            if str(epoch) in catalog['epochs']:
+                catalog['epochs'][str(epoch)]['metrics'] = metrics
+            self.save(catalog)
+
+    def list(self):
+        """Returns catalog entries of all checkpoints sorted by epoch"""
+        return sorted(self.load()['epochs'].values(), key=lambda entry: entry['epoch'])
+
+    def entry(self, epoch):
+        """Returns catalog entry of an epoch (nodes are in pipeline order) or None"""
+        return self.load()['epochs'].get(str(epoch))
+
+    def latest(self):
+        """Returns the number of the last epoch that has a checkpoint"""
+        epochs = self.load()['epochs']
+        return max(int(epoch) for epoch in epochs) if epochs else None
+
+    def best(self, metric, mode='min'):
+        """Returns the number of the epoch with the best value of a metric or None if no epoch has it"""
+        scored = [entry for entry in self.list() if metric in entry.get('metrics', {})]
+        if not scored:
+            return None
+
+        choose = min if mode == 'min' else max
+        return choose(scored, key=lambda entry: entry['metrics'][metric])['epoch']
+
+    def apply_retention(self, keep_last=None, keep_best=None, metric=None, mode='min'):
+        """Removes checkpoints which are neither among keep_last latest ones nor among keep_best best ones
+
+        The latest checkpoint is always kept, so that training can be resumed. Blobs no longer
+        referenced by remaining checkpoints are removed as well.
+        """
+        with catalog_lock:
+            catalog = self.load_for_update()
+            entries = sorted(catalog['epochs'].values(), key=lambda entry: entry['epoch'])
+            if not entries:
+                return
+
+            keep = {entries[-1]['epoch']}
+            if keep_last:
+                keep.update(entry['epoch'] for entry in entries[-keep_last:])
+            if keep_best and metric:
+                scored = [entry for entry in entries if metric in entry.get('metrics', {})]
+                scored.sort(key=lambda entry: entry['metrics'][metric], reverse=mode == 'max')
+                keep.update(entry['epoch'] for entry in scored[:keep_best])
+
+            if not keep_last and not keep_best:
+                return
+
+            for entry in entries:
+                if entry['epoch'] not in keep:
+                    shutil.rmtree(os.path.join(self.checkpoints_dir, str(entry['epoch'])), ignore_errors=True)
+                    del catalog['epochs'][str(entry['epoch'])]
+
+            self.save(catalog)
+
+            referenced = set().union(*[entry['blobs'] for entry in catalog['epochs'].values()])
+            BlobStore(os.path.join(self.checkpoints_dir, blobs_dir_name)).collect_garbage(referenced)
+
+
+class CheckpointWriter:
+    """Writes checkpoints in a background thread
+
+    Training only pays for copying state into CPU memory. The queue of pending checkpoints is bounded,
+    so that training blocks rather than piling up snapshots when writing is slower than training.
+    Pending checkpoints are written before the interpreter exits.
+    """
+    def __init__(self, max_pending=1):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.wait)
+
+    def submit(self, checkpoints_dir, epoch, dicts, deduplicate=False, retention=None, progress=None):
+        self.raise_error()
+        self.queue.put((checkpoints_dir, epoch, snapshot(dicts), deduplicate, retention, progress))
+
+    def wait(self):
+        """Blocks until all submitted checkpoints are written"""
+        self.queue.join()
+        self.raise_error()
+
+    def run(self):
+        while True:
+            checkpoints_dir, epoch, dicts, deduplicate, retention, progress = self.queue.get()
+            try:
+                write_checkpoint(checkpoints_dir, epoch, dicts, deduplicate, retention, progress)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Failed to write a checkpoint') from error
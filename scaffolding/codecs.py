@@ -0,0 +1,75 @@
+import pickle
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+def encode_value(value):
+    """Converts a single element of an example into raw bytes
+
+    :param value: tensor, list of integers, bytes, string, Pillow image or any other picklable object
+    :return: a tuple of (kind, dtype, shape, raw bytes) where dtype and shape describe
+    how to interpret the bytes for a given kind of value
+    """
+    if isinstance(value, torch.Tensor):
+        tensor = value.detach().cpu().contiguous()
+        dtype = str(tensor.dtype).replace('torch.', '')
+        if tensor.dtype == torch.bfloat16:
+            # numpy has no bfloat16, so raw bits are stored instead
+            tensor = tensor.view(torch.int16)
+        return 'tensor', dtype, tuple(value.shape), tensor.numpy().tobytes()
+
+    if isinstance(value, (list, tuple)) and value and all(isinstance(v, int) for v in value):
+        return 'int_list', 'int64', (len(value),), np.array(value, dtype=np.int64).tobytes()
+
+    if isinstance(value, bytes):
+        return 'bytes', None, None, value
+
+    if isinstance(value, str):
+        return 'str', None, None, value.encode('utf-8')
+
+    if isinstance(value, Image.Image):
+        # decoded pixels are stored, so that reading an image does not involve decompression
+        return 'image', value.mode, value.size, value.tobytes()
+
+    return 'pickle', None, None, pickle.dumps(value)
+
+
+def decode_value(raw, kind, dtype, shape):
+    """Reverses encode_value
+
+    :param raw: bytes-like object (e.g. bytes, memoryview or a slice of numpy memmap)
+    """
+    if kind == 'tensor':
+        if dtype == 'bfloat16':
+            array = np.frombuffer(raw, dtype=np.int16).reshape(shape)
+            return torch.from_numpy(array.copy()).view(torch.bfloat16)
+
+        array = np.frombuffer(raw, dtype=np.dtype(dtype)).reshape(shape)
+        return torch.from_numpy(array.copy())
+
+    if kind == 'int_list':
+        return np.frombuffer(raw, dtype=np.int64).tolist()
+
+    if kind == 'bytes':
+        return bytes(raw)
+
+    if kind == 'str':
+        return bytes(raw).decode('utf-8')
+
+    if kind == 'image':
+        return Image.frombytes(dtype, tuple(shape), bytes(raw))
+
+    return pickle.loads(bytes(raw))
+
+
+def stored_length(kind, shape, length_dim=-1):
+    """Returns length of an encoded value (as example_length of samplers would) from its metadata
+    or None when the value has to be decoded to find it out
+    """
+    if kind == 'tensor':
+        return shape[length_dim] if len(shape) > 0 else 1
+    if kind == 'int_list':
+        return shape[0]
+    return None
@@ -28,3 +28,56 @@ class StackTensors(BatchDivide):
         tensor_lists = super().__call__(batch)
         # todo: this is too naive implementation; handle other cases; raise errors for wrong data types/shapes
         return [torch.stack(lst) if isinstance(lst[0], torch.Tensor) else torch.tensor(lst) for lst in tensor_lists]
+
+
+class PadSequences(BatchDivide):
+    """Pads examples of different lengths to form tensors of equal shape
+
+    Returns a list of padded tensors (one per element of an example) followed by a list of
+    length tensors, i.e. [x, y, x_lengths, y_lengths] for examples of the form (x, y).
+    Lists of numbers are converted into 1D tensors first. Tensors are padded along every
+    dimension to the largest size in the batch, their length is measured along the last dimension.
+    """
+    def __init__(self, padding_value=0):
+        """
+        :param padding_value: value used to pad all elements of an example or a list of values,
+        one per element of an example
+        """
+        self.padding_value = padding_value
+
+    def __call__(self, batch):
+        columns = super().__call__(batch)
+
+        if isinstance(self.padding_value, list):
+            padding_values = self.padding_value
+        else:
+            padding_values = [self.padding_value] * len(columns)
+
+        padded = []
+        lengths = []
+        for values, padding_value in zip(columns, padding_values):
+            tensors = [v if isinstance(v, torch.Tensor) else torch.tensor(v) for v in values]
+            padded.append(pad_tensors(tensors, padding_value))
+            lengths.append(torch.LongTensor([t.size(-1) if t.dim() > 0 else 1 for t in tensors]))
+
+        return padded + lengths
+
+    def state_dict(self):
+        return dict(padding_value=self.padding_value)
+
+    def load(self, state_dict):
+        self.padding_value = state_dict['padding_value']
+
+
+def pad_tensors(tensors, padding_value=0):
+    """Stacks tensors of the same number of dimensions but different sizes into a single padded tensor
+
+    :param tensors: a list of tensors
+    :param padding_value: value to fill padded positions with
+    :return: tensor of shape (len(tensors), *max_shape)
+    """
+    max_shape = [max(sizes) for sizes in zip(*[t.shape for t in tensors])]
+    result = tensors[0].new_full([len(tensors)] + max_shape, padding_value)
+    for i, t in enumerate(tensors):
+        result[i][tuple(slice(0, size) for size in t.shape)] = t
+    return result
@@ -0,0 +1,110 @@
+import os
+
+import torch
+
+
+cache_artifacts_file = 'artifacts.bin'
+
+
+def is_compile_supported():
+    return hasattr(torch, 'compile')
+
+
+def compile_nodes(nodes, cache_dir):
+    """Compiles models of nodes with "compile" options, keeping compiled artifacts under cache_dir
+
+    Original modules are left as they are, so that checkpoints keep saving their own state_dict.
+    On PyTorch versions without torch.compile nodes keep running in eager mode.
+    """
+    nodes = [node for node in nodes if node.compile_options]
+    if not nodes:
+        return
+
+    if not is_compile_supported():
+        print(f'torch.compile is not available in PyTorch {torch.__version__}, nodes run in eager mode')
+        return
+
+    setup_compile_cache(cache_dir)
+
+    for node in nodes:
+        node.compiled = CompiledModel(node.net.instance, node.compile_options)
+
+
+def setup_compile_cache(cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # on-disk caches of inductor and triton are shared by all runs of the session
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+    os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+
+    inductor_config = getattr(getattr(torch, '_inductor', None), 'config', None)
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+
+    path = os.path.join(cache_dir, cache_artifacts_file)
+    if os.path.exists(path) and hasattr(getattr(torch, 'compiler', None), 'load_cache_artifacts'):
+        with open(path, 'rb') as f:
+            torch.compiler.load_cache_artifacts(f.read())
+
+
+def save_compile_cache(cache_dir):
+    """Saves artifacts compiled so far in a single file (on PyTorch versions supporting it)"""
+    if not hasattr(getattr(torch, 'compiler', None), 'save_cache_artifacts'):
+        return
+
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return
+
+    data, _ = artifacts
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, cache_artifacts_file)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class CompiledModel:
+    """Compiled counterpart of a model exposing its __call__ and run_inference methods"""
+    def __init__(self, module, compile_options):
+        kwargs = {'mode': compile_options['mode'], 'fullgraph': compile_options['fullgraph']}
+        fallback = compile_options['fallback']
+
+        self.forward = CompiledFunction(module, torch.compile(module, **kwargs), fallback)
+
+        if hasattr(module, 'run_inference'):
+            compiled = torch.compile(module.run_inference, **kwargs)
+            self.run_inference = CompiledFunction(module.run_inference, compiled, fallback)
+
+    def __call__(self, *args):
+        return self.forward(*args)
+
+
+class CompiledFunction:
+    """Calls a compiled function, optionally switching to the eager one for good when compilation fails
+    (e.g. on a graph break when the whole graph is required)
+    """
+    def __init__(self, eager_fn, compiled_fn, fallback):
+        self.eager_fn = eager_fn
+        self.compiled_fn = compiled_fn
+        self.fallback = fallback
+        self.use_eager = False
+
+    def __call__(self, *args):
+        if self.use_eager:
+            return self.eager_fn(*args)
+
+        try:
+            return self.compiled_fn(*args)
+        except Exception as e:
+            if not (self.fallback and is_compilation_error(e)):
+                raise
+
+            print(f'Compilation failed, falling back to eager mode: {e}')
+            self.use_eager = True
+            return self.eager_fn(*args)
+
+
+def is_compilation_error(exc):
+    return type(exc).__module__.startswith(('torch._dynamo', 'torch._inductor'))
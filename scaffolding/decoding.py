@@ -0,0 +1,160 @@
+import torch
+from torch.nn import functional as F
+
+
+def select_state(state, batch_dims, indices):
+    """Selects entries of a decoder state along the batch dimension of every tensor
+
+    :param state: a tuple of tensors (None entries are kept as they are)
+    :param batch_dims: a tuple with the batch dimension of every tensor of the state
+    :param indices: indices of entries to select (may contain repetitions)
+    :type indices: long tensor of shape (n,)
+    :return: a tuple of tensors
+    """
+    return tuple(t if t is None else t.index_select(dim, indices.to(t.device))
+                 for t, dim in zip(state, batch_dims))
+
+
+class GreedySearch:
+    """Batched greedy decoding
+
+    Sequences that emit EOS token are removed from the batch, so that later steps only
+    run over sequences which are still being decoded.
+    """
+    def __init__(self, eos, max_length=40):
+        self.eos = eos
+        self.max_length = max_length
+
+    def __call__(self, step_fn, start_tokens, state, batch_dims):
+        """Decodes a batch of sequences
+
+        :param step_fn: function taking (tokens, state) and returning (scores, new_state), where
+        tokens is a long tensor of shape (n,) and scores is a tensor of shape (n, num_classes)
+        :param start_tokens: tokens to start decoding from
+        :type start_tokens: long tensor of shape (batch_size,)
+        :param state: initial state passed to step_fn (e.g. decoder hidden state and encoder outputs)
+        :param batch_dims: batch dimension of every tensor of the state
+        :return: a list of decoded token lists (including EOS if it was emitted), one per sequence
+        """
+        batch_size = len(start_tokens)
+        results = [[] for _ in range(batch_size)]
+
+        active = torch.arange(batch_size)
+        tokens = start_tokens
+
+        for _ in range(self.max_length):
+            scores, state = step_fn(tokens, state)
+            tokens = scores.argmax(dim=-1)
+
+            for i, token in zip(active.tolist(), tokens.tolist()):
+                results[i].append(token)
+
+            unfinished = tokens != self.eos
+            if not unfinished.all():
+                keep = unfinished.nonzero(as_tuple=True)[0]
+                active = active[keep.cpu()]
+                tokens = tokens[keep]
+                state = select_state(state, batch_dims, keep)
+
+            if len(active) == 0:
+                break
+
+        return results
+
+
+class BeamSearch:
+    """Batched beam search decoding
+
+    Every sequence keeps beam_width hypotheses. A hypothesis ending with EOS is moved to a list of
+    finished ones. A sequence leaves the batch as soon as it has beam_width finished hypotheses and
+    none of the active ones can beat them anymore (scores are sums of log probabilities,
+    so they never increase).
+    """
+    def __init__(self, eos, max_length=40, beam_width=4):
+        self.eos = eos
+        self.max_length = max_length
+        self.beam_width = beam_width
+
+    def __call__(self, step_fn, start_tokens, state, batch_dims):
+        """Decodes a batch of sequences, see GreedySearch.__call__ for the description of arguments
+
+        :return: a list with the best hypothesis for every sequence
+        """
+        k = self.beam_width
+        batch_size = len(start_tokens)
+        device = start_tokens.device
+
+        # every sequence is represented by k consecutive rows
+        rows = torch.arange(batch_size, device=device).repeat_interleave(k)
+        state = select_state(state, batch_dims, rows)
+        tokens = start_tokens.index_select(0, rows)
+
+        # initially all hypotheses are identical, so only the first one is allowed to expand
+        scores = torch.full((batch_size, k), float('-inf'), device=device)
+        scores[:, 0] = 0.
+        histories = tokens.new_zeros(batch_size * k, 0)
+
+        active = list(range(batch_size))
+        finished = [[] for _ in range(batch_size)]
+
+        for _ in range(self.max_length):
+            logits, state = step_fn(tokens, state)
+            log_probs = F.log_softmax(logits.float(), dim=-1)
+
+            num_active = len(active)
+            num_classes = log_probs.size(-1)
+
+            candidates = (scores.view(-1, 1) + log_probs).view(num_active, k * num_classes)
+            top_scores, top_indices = candidates.topk(min(2 * k, k * num_classes), dim=1)
+            top_beams = top_indices // num_classes
+            top_tokens = top_indices % num_classes
+
+            is_eos = top_tokens == self.eos
+
+            # EOS among the k best candidates finishes a hypothesis
+            for r, j in (is_eos[:, :k] & (top_scores[:, :k] > float('-inf'))).nonzero().tolist():
+                history = histories[r * k + top_beams[r, j]].tolist()
+                finished[active[r]].append((top_scores[r, j].item(), history + [self.eos]))
+
+            scores, selected = top_scores.masked_fill(is_eos, float('-inf')).topk(k, dim=1)
+            beams = top_beams.gather(1, selected)
+            tokens = top_tokens.gather(1, selected).view(-1)
+
+            parent_rows = (torch.arange(num_active, device=device).unsqueeze(1) * k + beams).view(-1)
+            histories = torch.cat([histories[parent_rows], tokens.unsqueeze(1)], dim=1)
+            state = select_state(state, batch_dims, parent_rows)
+
+            best_scores = scores[:, 0].tolist()
+            keep = [r for r, i in enumerate(active) if not self.is_done(finished[i], best_scores[r])]
+
+            if len(keep) < num_active:
+                active = [active[r] for r in keep]
+                keep = torch.tensor(keep, dtype=torch.long, device=device)
+                keep_rows = (keep.unsqueeze(1) * k + torch.arange(k, device=device)).view(-1)
+
+                scores = scores[keep]
+                tokens = tokens[keep_rows]
+                histories = histories[keep_rows]
+                state = select_state(state, batch_dims, keep_rows)
+
+            if not active:
+                break
+
+        # hypotheses which have not emitted EOS within max_length steps still compete
+        for r, i in enumerate(active):
+            for b in range(k):
+                score = scores[r, b].item()
+                if score > float('-inf'):
+                    finished[i].append((score, histories[r * k + b].tolist()))
+
+        return [max(hypotheses, key=lambda h: h[0])[1] if hypotheses else [] for hypotheses in finished]
+
+    def is_done(self, finished, best_active_score):
+        if best_active_score == float('-inf'):
+            return True
+
+        if len(finished) < self.beam_width:
+            return False
+
+        worst_kept = sorted(score for score, _ in finished)[-self.beam_width]
+        return best_active_score <= worst_kept
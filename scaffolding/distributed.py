@@ -0,0 +1,129 @@
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    """Waits for all processes (does nothing outside of data-parallel training)"""
+    if is_distributed():
+        dist.barrier()
+
+
+def launch(worker_fn, nproc, port, *args):
+    """Runs worker_fn in nproc local processes forming a process group on gloo backend
+
+    Every process calls worker_fn(*args) once the process group is initialized.
+    CPU threads are split evenly between processes, so that replicas do not oversubscribe cores.
+
+    :param worker_fn: a picklable (module level) function
+    :param nproc: number of processes (data-parallel replicas)
+    :param port: free TCP port used by processes to find each other
+    """
+    mp.spawn(run_worker, args=(nproc, port, worker_fn, args), nprocs=nproc, join=True)
+
+
+def run_worker(rank, world_size, port, worker_fn, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+
+    num_threads = max(1, (os.cpu_count() or 1) // world_size)
+    torch.set_num_threads(num_threads)
+
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        worker_fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def all_reduce_gradients(prediction_pipeline):
+    """Averages gradients of every node of a pipeline across all processes
+
+    Gradients of a node are flattened into a single buffer, so that there is one collective call per node.
+    Every trainable parameter takes part (with zeros when it got no gradient in this process),
+    so that all processes reduce buffers of the same size. The buffer ends with a flag per parameter
+    telling whether it got a gradient, parameters that got none in any process are left without one,
+    so that optimizers skip them instead of decaying them with a zero gradient.
+    """
+    world_size = get_world_size()
+
+    for node in prediction_pipeline:
+        if node.frozen:
+            continue
+
+        params = [p for p in node.net.parameters() if p.requires_grad]
+        if not params:
+            continue
+
+        grads = [(p.grad if p.grad is not None else torch.zeros_like(p)).reshape(-1) for p in params]
+        flags = grads[0].new_tensor([float(p.grad is not None) for p in params])
+        buffer = torch.cat(grads + [flags])
+        dist.all_reduce(buffer, op=dist.ReduceOp.SUM)
+        buffer /= world_size
+
+        present = buffer[-len(params):] > 0
+        offset = 0
+        for p, has_grad in zip(params, present.tolist()):
+            grad = buffer[offset:offset + p.numel()].view_as(p)
+            if not has_grad:
+                p.grad = None
+            elif p.grad is None:
+                p.grad = grad.clone()
+            else:
+                p.grad.copy_(grad)
+            offset += p.numel()
+
+
+def broadcast_parameters(prediction_pipeline, src=0):
+    """Makes parameters and buffers of every node equal to the ones of process src"""
+    for node in prediction_pipeline:
+        for tensor in list(node.net.parameters()) + list(node.net.buffers()):
+            dist.broadcast(tensor.data, src=src)
+
+
+class DistributedBatchSampler:
+    """Gives every process its own share of batches produced by a batch sampler
+
+    Wrapped sampler must produce the same batches in the same order in every process
+    (e.g. be seeded identically). Batch list is padded with batches from its beginning,
+    so that all processes run the same number of iterations.
+    """
+    def __init__(self, batch_sampler, num_replicas=None, rank=None):
+        self.batch_sampler = batch_sampler
+        self.num_replicas = num_replicas or get_world_size()
+        self.rank = get_rank() if rank is None else rank
+
+    def __getattr__(self, attr):
+        if attr == 'batch_sampler':
+            raise AttributeError(attr)
+        return getattr(self.batch_sampler, attr)
+
+    def __iter__(self):
+        batches = list(self.batch_sampler)
+        if not batches:
+            return iter([])
+
+        total = len(self) * self.num_replicas
+        batches = (batches * (total // len(batches) + 1))[:total]
+        return iter(batches[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return (len(self.batch_sampler) + self.num_replicas - 1) // self.num_replicas
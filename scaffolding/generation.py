@@ -0,0 +1,207 @@
+import json
+import os
+import shutil
+import multiprocessing
+from itertools import islice
+
+from scaffolding.utils import instantiate_class, import_function
+from scaffolding.exceptions import InvalidParameterError
+
+
+def generate_data(data_dict):
+    """Generates a dataset as described by "data_generator" section of data config
+
+    Examples are generated in chunks of "chunk_size" examples. Every chunk is saved into its own directory
+    with a single bulk write and marked as done. Once all chunks are done, they get merged into output_dir
+    in order. When "num_workers" > 1, chunks are generated by a pool of processes. In that case the generator
+    must support random access (define __len__ and __getitem__), so that each worker can produce
+    its own range of indices.
+
+    An interrupted run leaves its progress in a working directory inside output_dir and
+    continues from the last completed chunk when called again.
+    """
+    if "data_generator" not in data_dict:
+        return
+
+    generator_config = data_dict["data_generator"]
+    output_dir = generator_config["output_dir"]
+    work_dir = os.path.join(output_dir, '.generation')
+
+    if os.path.isdir(output_dir) and not os.path.isdir(work_dir):
+        # data generation has been completed already
+        return
+
+    os.makedirs(work_dir, exist_ok=True)
+
+    num_workers = generator_config.get('num_workers', 1)
+    chunk_size = generator_config.get('chunk_size', 1000)
+
+    generator = build_generator(generator_config)
+    random_access = hasattr(generator, '__len__') and hasattr(generator, '__getitem__')
+
+    if random_access:
+        chunks = list(enumerate(index_ranges(len(generator), chunk_size)))
+        pending = [(chunk_id, start, stop) for chunk_id, (start, stop) in chunks
+                   if not is_chunk_done(work_dir, chunk_id)]
+
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(generator_config,)) as pool:
+                jobs = [(work_dir, chunk_id, start, stop) for chunk_id, start, stop in pending]
+                for _ in pool.imap_unordered(generate_chunk_in_worker, jobs):
+                    pass
+        else:
+            for chunk_id, start, stop in pending:
+                examples = [generator[i] for i in range(start, stop)]
+                save_chunk(generator_config, examples, work_dir, chunk_id, start)
+        num_chunks = len(chunks)
+    elif num_workers > 1:
+        raise InvalidParameterError(
+            f'Data generator "{generator_config["class"]}" must implement __len__ and __getitem__ '
+            f'to be run by multiple workers'
+        )
+    else:
+        num_chunks = generate_sequentially(generator, generator_config, work_dir, chunk_size)
+
+    merge_chunks(work_dir, output_dir, num_chunks)
+    shutil.rmtree(work_dir)
+
+
+def build_generator(generator_config):
+    args = generator_config.get('args', [])
+    kwargs = generator_config.get('kwargs', {})
+    return instantiate_class(generator_config["class"], *args, **kwargs)
+
+
+def index_ranges(size, chunk_size):
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def generate_sequentially(generator, generator_config, work_dir, chunk_size):
+    """Generates chunks by iterating over the generator, returns the number of chunks"""
+    iterator = iter(generator)
+    chunk_id = 0
+    while True:
+        start = chunk_id * chunk_size
+        examples = list(islice(iterator, chunk_size))
+        if not examples:
+            return chunk_id
+
+        # examples of completed chunks still have to be drawn from the iterator, but are not saved again
+        if not is_chunk_done(work_dir, chunk_id):
+            save_chunk(generator_config, examples, work_dir, chunk_id, start)
+        chunk_id += 1
+
+
+# generator instance and its config owned by a worker process of a pool
+worker_generator = None
+worker_config = None
+
+
+def init_worker(generator_config):
+    global worker_generator, worker_config
+    worker_generator = build_generator(generator_config)
+    worker_config = generator_config
+
+
+def generate_chunk_in_worker(job):
+    work_dir, chunk_id, start, stop = job
+    examples = [worker_generator[i] for i in range(start, stop)]
+    save_chunk(worker_config, examples, work_dir, chunk_id, start)
+
+
+def save_chunk(generator_config, examples, work_dir, chunk_id, start_index):
+    chunk_dir = os.path.join(work_dir, str(chunk_id))
+    if os.path.exists(chunk_dir):
+        # left from an interrupted run
+        shutil.rmtree(chunk_dir)
+    os.makedirs(chunk_dir)
+
+    save_examples = get_save_examples_fn(generator_config)
+    save_examples(examples, chunk_dir, start_index)
+
+    # marker is created last, so that a chunk is never considered done before all its data is written
+    open(os.path.join(work_dir, f'{chunk_id}.done'), 'w').close()
+
+
+def is_chunk_done(work_dir, chunk_id):
+    return os.path.exists(os.path.join(work_dir, f'{chunk_id}.done'))
+
+
+def get_save_examples_fn(generator_config):
+    save_examples_name = generator_config.get('save_examples_fn')
+    if save_examples_name:
+        return import_function(save_examples_name)
+
+    save_example_name = generator_config.get('save_example_fn')
+    if save_example_name:
+        save_example = import_function(save_example_name)
+
+        def save_examples(examples, output_dir, start_index):
+            for i, example in enumerate(examples, start=start_index):
+                save_example(example, output_dir, i)
+
+        return save_examples
+
+    return default_save_examples
+
+
+def default_save_examples(examples, output_dir, start_index):
+    """Appends every element of examples as a line to a file named by its position in an example,
+    every file gets written with a single call
+    """
+    columns = zip(*examples)
+    for j, column in enumerate(columns):
+        path = os.path.join(output_dir, str(j))
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(''.join(f'{elem}\n' for elem in column))
+
+
+def merge_chunks(work_dir, output_dir, num_chunks):
+    """Merges chunk directories into output_dir in order of chunk ids
+
+    Files present in several chunks (e.g. a text file with one line per example) are concatenated,
+    other files are moved as they are. Sizes of files are recorded before a chunk is merged,
+    so that a merge interrupted half way is rolled back and repeated.
+    """
+    for chunk_id in range(num_chunks):
+        merged_marker = os.path.join(work_dir, f'{chunk_id}.merged')
+        if os.path.exists(merged_marker):
+            continue
+
+        chunk_dir = os.path.join(work_dir, str(chunk_id))
+        sizes_path = os.path.join(work_dir, f'{chunk_id}.merging')
+
+        if os.path.exists(sizes_path):
+            with open(sizes_path, encoding='utf-8') as f:
+                sizes = json.loads(f.read())
+            for path, size in sizes.items():
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+        else:
+            sizes = {path: os.path.getsize(path) for path in destination_paths(chunk_dir, output_dir)
+                     if os.path.exists(path)}
+            with open(sizes_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(sizes))
+
+        for root, _, file_names in os.walk(chunk_dir):
+            for file_name in file_names:
+                source = os.path.join(root, file_name)
+                destination = os.path.join(output_dir, os.path.relpath(source, chunk_dir))
+
+                if destination in sizes:
+                    with open(source, 'rb') as src, open(destination, 'ab') as dest:
+                        shutil.copyfileobj(src, dest)
+                else:
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    os.replace(source, destination)
+
+        open(merged_marker, 'w').close()
+        shutil.rmtree(chunk_dir)
+        os.remove(sizes_path)
+
+
+def destination_paths(chunk_dir, output_dir):
+    for root, _, file_names in os.walk(chunk_dir):
+        for file_name in file_names:
+            source = os.path.join(root, file_name)
+            yield os.path.join(output_dir, os.path.relpath(source, chunk_dir))
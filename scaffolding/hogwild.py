@@ -0,0 +1,133 @@
+import os
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import Subset
+
+from .utils import switch_to_train_mode
+
+
+def share_pipeline_memory(prediction_pipeline):
+    """Moves parameters, buffers and optimizer state tensors of every node into shared memory
+
+    Optimizer state is created beforehand (see init_optimizer_state), so that workers update
+    the same moments as the parent and checkpoints of the parent contain them.
+    """
+    for node in prediction_pipeline:
+        node.net.instance.share_memory()
+
+        if not node.frozen:
+            init_optimizer_state(node.optimizer.instance)
+
+        for param_state in node.optimizer.instance.state.values():
+            for value in param_state.values():
+                if isinstance(value, torch.Tensor):
+                    value.share_memory_()
+
+
+def init_optimizer_state(optimizer):
+    """Makes an optimizer create its state (e.g. moments of Adam) without changing parameters
+
+    A step is made with zero gradients and zero learning rates, after which step counters are reset.
+    """
+    params = [p for group in optimizer.param_groups for p in group['params'] if p.requires_grad]
+    if not params or all(p in optimizer.state for p in params):
+        return
+
+    saved_grads = [p.grad for p in params]
+    saved_lrs = [group['lr'] for group in optimizer.param_groups]
+
+    for p in params:
+        p.grad = torch.zeros_like(p)
+    for group in optimizer.param_groups:
+        group['lr'] = 0.
+
+    optimizer.step()
+
+    for p, grad in zip(params, saved_grads):
+        p.grad = grad
+    for group, lr in zip(optimizer.param_groups, saved_lrs):
+        group['lr'] = lr
+
+    for param_state in optimizer.state.values():
+        if 'step' in param_state:
+            step = param_state['step']
+            param_state['step'] = step.zero_() if isinstance(step, torch.Tensor) else 0
+
+
+def advance_step_counters(prediction_pipeline, num_steps):
+    """Adds steps made by workers to step counters that are plain numbers (they can not be shared)"""
+    for node in prediction_pipeline:
+        if node.frozen:
+            continue
+
+        for param_state in node.optimizer.instance.state.values():
+            if 'step' in param_state and not isinstance(param_state['step'], torch.Tensor):
+                param_state['step'] += num_steps
+
+
+def run_hogwild_epoch(data_pipeline, train_set, prediction_pipeline, loss_fn, epoch, num_processes,
+                      make_callbacks=None, accumulation_steps=1):
+    """Trains a pipeline for one epoch with num_processes forked workers updating shared parameters without locks
+
+    Every worker runs Trainer.run_epoch over its own disjoint shard of the training set.
+    Workers load data in the main thread (no loader processes), CPU threads are split evenly between them.
+    A forked process only gets the thread that forked it, so the parent must not have other threads
+    (e.g. a checkpoint writer or loader threads) at this point; the thread pool of the pipeline is stopped here.
+
+    :param data_pipeline: data pipeline of the session
+    :param train_set: training set which gets split into shards
+    :param prediction_pipeline: pipeline being trained (its nodes must have been put into shared memory)
+    :param loss_fn: loss function
+    :param epoch: epoch number (used for seeding workers)
+    :param num_processes: number of worker processes
+    :param make_callbacks: optional function taking worker rank and returning a list of Trainer callbacks
+    :param accumulation_steps: number of batches whose gradients a worker accumulates before making a step
+    """
+    context = mp.get_context('fork')
+
+    # a worker would inherit the pool with no threads behind it
+    prediction_pipeline.shutdown_executor()
+
+    # numbers of optimizer steps made by every worker
+    step_counts = torch.zeros(num_processes, dtype=torch.int64).share_memory_()
+
+    workers = []
+    for rank in range(num_processes):
+        args = (rank, num_processes, data_pipeline, train_set, prediction_pipeline, loss_fn, epoch,
+                make_callbacks, accumulation_steps, step_counts)
+        worker = context.Process(target=hogwild_worker, args=args)
+        worker.start()
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+
+    failed = [rank for rank, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'Hogwild workers {failed} exited with an error')
+
+    advance_step_counters(prediction_pipeline, int(step_counts.sum()))
+
+
+def hogwild_worker(rank, num_processes, data_pipeline, train_set, prediction_pipeline, loss_fn, epoch,
+                   make_callbacks, accumulation_steps, step_counts):
+    from .training import Trainer
+
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_processes))
+    torch.manual_seed(epoch * num_processes + rank)
+
+    shard = Subset(train_set, range(rank, len(train_set), num_processes))
+
+    collate_fn = data_pipeline.get_collate_fn(prediction_pipeline.batch_adapter)
+    loader = data_pipeline.make_loader(shard, collate_fn, shuffle=True, num_workers=0)
+
+    trainer = Trainer(loader, prediction_pipeline, loss_fn, accumulation_steps)
+    for cb in (make_callbacks(rank) if make_callbacks else []):
+        trainer.add_callback(cb)
+
+    switch_to_train_mode(prediction_pipeline)
+    trainer.run_epoch()
+
+    # every accumulation window ends with a step, including the last incomplete one
+    step_counts[rank] = (len(loader) + accumulation_steps - 1) // accumulation_steps
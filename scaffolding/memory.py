@@ -0,0 +1,47 @@
+def reset_peak_memory():
+    """Resets peak resident set size of the process to its current value (Linux only)
+
+    :return: True if peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_memory():
+    """Returns peak resident set size of the process in bytes or None if it is not available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+        # can not be reset, kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+def resident_memory():
+    """Returns current resident set size of the process in bytes or None if it is not available (Linux only)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def format_memory(num_bytes):
+    if num_bytes is None:
+        return 'n/a'
+    return f'{num_bytes / 2 ** 20:.1f} MB'
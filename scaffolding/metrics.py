@@ -50,11 +50,34 @@ class Metric:
         tensors = [lookup_table[arg] for arg in self.metric_args]
 
         tensors = self.change_device(tensors)
+        tensors = self.to_full_precision(tensors)
         tensors = self.transform_fn(*tensors)
         # the above operation could change devices
         tensors = self.change_device(tensors)
         return self.metric_fn(*tensors)
 
+    def argument_names(self):
+        return list(self.metric_args)
+
+    @property
+    def reduction(self):
+        return getattr(self.metric_fn, 'reduction', 'mean')
+
+    def normalizer(self, targets):
+        """Returns the number that the summed loss of a batch is divided by, or None when it is
+        not known from targets (in which case batches are assumed to be averaged over examples)
+        """
+        if self.reduction == 'sum':
+            return 1
+        return None
+
+    def to_full_precision(self, tensors):
+        """Casts reduced precision floating point tensors (e.g. produced under bfloat16 autocast) to float32,
+        so that metrics and losses are reduced in full precision
+        """
+        return [arg.float() if isinstance(arg, torch.Tensor) and arg.is_floating_point()
+                and arg.dtype != torch.float64 else arg for arg in tensors]
+
     def change_device(self, tensors):
         """Moves all tensors that participate in metric calculation to a given device
 
@@ -67,6 +90,52 @@ class Metric:
                 for arg in tensors]
 
 
+class MaskedMetric(Metric):
+    """Metric that ignores padded positions of a target tensor
+
+    Positions of the target at or past the length of the corresponding sequence are set to
+    ignore_index, so that a criterion such as CrossEntropyLoss skips them both in the sum and
+    in the number of elements used for averaging.
+    """
+    def __init__(self, name, metric_fn, metric_args, transform_fn, device, target_name, lengths_name,
+                 ignore_index):
+        super().__init__(name, metric_fn, metric_args, transform_fn, device)
+        self.target_name = target_name
+        self.lengths_name = lengths_name
+        self.ignore_index = ignore_index
+
+    def argument_names(self):
+        return super().argument_names() + [self.target_name, self.lengths_name]
+
+    def normalizer(self, targets):
+        """Number of positions which are not ignored for averaging losses"""
+        if self.reduction == 'sum':
+            return 1
+        if self.target_name not in targets or self.lengths_name not in targets:
+            return None
+
+        target = self.mask_padding({}, targets)[self.target_name]
+        return int((target != self.ignore_index).sum())
+
+    def __call__(self, outputs, targets):
+        return super().__call__(outputs, self.mask_padding(outputs, targets))
+
+    def mask_padding(self, outputs, targets):
+        lookup_table = targets.copy()
+        lookup_table.update(outputs)
+
+        target = lookup_table[self.target_name]
+        lengths = lookup_table[self.lengths_name].to(target.device)
+
+        positions = torch.arange(target.size(1), device=target.device)
+        padding_mask = positions.unsqueeze(0) >= lengths.unsqueeze(1)
+        padding_mask = padding_mask.view(padding_mask.shape + (1,) * (target.dim() - 2))
+
+        targets = targets.copy()
+        targets[self.target_name] = target.masked_fill(padding_mask, self.ignore_index)
+        return targets
+
+
 # todo: support exponentially weighted averages too
 class MovingAverage:
     def __init__(self):
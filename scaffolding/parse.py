@@ -11,10 +11,17 @@ import torch.optim as optim
 
 import torchmetrics
 
-from scaffolding.metrics import metric_functions, Metric
+from scaffolding.metrics import metric_functions, Metric, MaskedMetric
 from scaffolding.utils import SimpleSplitter, instantiate_class, import_function, import_entity, \
-    AdaptedCollator, WrappedDataset, DecoratedInstance, GenericSerializableInstance, change_batch_device
+    AdaptedCollator, WrappedDataset, IndexedDataset, IndexedCollator, DecoratedInstance, GenericSerializableInstance, \
+    change_batch_device, can_read_ahead
 from scaffolding.store import store
+from scaffolding.caching import CachedDataset, example_cache_key
+from scaffolding.generation import generate_data
+from scaffolding.resumption import ResumableBatchSampler, ShuffledSampler
+from scaffolding.samplers import ReadAheadBatchSampler
+from scaffolding.distributed import is_distributed, is_main_process, barrier, DistributedBatchSampler
+from scaffolding.activation_checkpointing import enable_activation_checkpointing
 from scaffolding.exceptions import InvalidParameterError
 
 
@@ -34,41 +41,9 @@ def get_transform_pipeline(transform_config):
     return transforms.Compose([])
 
 
-def generate_data(data_dict):
-    if "data_generator" not in data_dict:
-        return
-
-    generator_config = data_dict["data_generator"]
-
-    class_name = generator_config["class"]
-    output_dir = generator_config["output_dir"]
-
-    if os.path.isdir(output_dir):
-        return
-
-    os.makedirs(output_dir)
-
-    args = generator_config.get('args', [])
-    kwargs = generator_config.get('kwargs', {})
-    save_example_name = generator_config.get('save_example_fn')
-
-    save_example = import_function(save_example_name) if save_example_name else default_save_example
-
-    generator = instantiate_class(class_name, *args, **kwargs)
-
-    for i, inputs in enumerate(generator):
-        save_example(inputs, output_dir, i)
-
-
-def default_save_example(example, output_dir, index):
-    for j, elem in enumerate(example):
-        path = os.path.join(output_dir, str(j))
-        with open(path, 'a', encoding='utf-8') as f:
-            f.write(f'{elem}\n')
-
-
 class DataPipeline:
-    def __init__(self, dataset, transform, splitter, preprocessors, collator, batch_size, device_str):
+    def __init__(self, dataset, transform, splitter, preprocessors, collator, batch_size, device_str,
+                 adapt_in_workers=False, loader_params=None, example_cache_dir=None, batch_sampler=None):
         self.dataset = dataset
         self.transform = transform
         self.splitter = splitter
@@ -76,8 +51,12 @@ class DataPipeline:
         self.collator = collator
         self.batch_size = batch_size
         self.device_str = device_str
+        self.adapt_in_workers = adapt_in_workers
+        self.loader_params = parse_loader_params(loader_params or {})
+        self.example_cache_dir = example_cache_dir
+        self.batch_sampler = batch_sampler
 
-    def get_data_loaders(self):
+    def get_datasets(self):
         # todo: this is a quick fix, refactor later
         data_dict = {
             'dataset_name': self.dataset.class_name,
@@ -91,14 +70,133 @@ class DataPipeline:
             train_set = WrappedDataset(train_set, self.preprocessors)
             test_set = WrappedDataset(test_set, self.preprocessors)
 
-        train_loader = torch.utils.data.DataLoader(train_set, batch_size=self.batch_size,
-                                                   shuffle=True, num_workers=2, collate_fn=self.collator)
+        if self.example_cache_dir:
+            train_set = self.get_cached_dataset(train_set, 'train')
+            test_set = self.get_cached_dataset(test_set, 'val')
+        else:
+            # lengths of examples computed for batch samplers outlive datasets of this call (see dataset_lengths)
+            train_set.lengths_key = self.dataset_key(train_set, 'train')
+            test_set.lengths_key = self.dataset_key(test_set, 'val')
 
-        test_loader = torch.utils.data.DataLoader(test_set, batch_size=self.batch_size,
-                                                  shuffle=False, num_workers=2, collate_fn=self.collator)
+        return train_set, test_set
 
+    def dataset_key(self, dataset, split_name):
+        """Returns a hash of dataset identity and preprocessors state of a given split"""
+        dataset_identity = {
+            'dataset': self.dataset.to_dict(),
+            'transform': self.transform,
+            'splitter': self.splitter.to_dict(),
+            'split': split_name,
+            'size': len(dataset)
+        }
+        return example_cache_key(dataset_identity, self.preprocessors)
+
+    def get_cached_dataset(self, dataset, split_name):
+        """Returns a dataset of preprocessed examples read from memory-mapped cache.
+
+        Cache is built on first use. It is keyed by dataset identity and preprocessors state,
+        so that changing either of them results in a new cache rather than a stale one.
+        """
+        key = self.dataset_key(dataset, split_name)
+        cache_dir = os.path.join(self.example_cache_dir, key)
+
+        # in data-parallel training the cache is built once by the main process while others wait for it
+        if is_main_process() and not os.path.isdir(cache_dir):
+            os.makedirs(self.example_cache_dir, exist_ok=True)
+            CachedDataset.build(dataset, cache_dir, num_workers=self.loader_params['num_workers'])
+        barrier()
+        return CachedDataset(cache_dir)
+
+    def get_data_loaders(self, batch_adapter=None, indexed=False, resumable=False, **overrides):
+        """Returns training and test loaders
+
+        :param batch_adapter: batch adapter composed into collator when adapt_in_workers is set
+        :param indexed: whether training batches come as IndexedBatch objects carrying dataset indices
+        :param resumable: whether the training loader gets a ResumableBatchSampler, so that an epoch
+        can be resumed from a given batch
+        :param overrides: loader parameters replacing the ones of the data pipeline (e.g. persistent_workers)
+        """
+        train_set, test_set = self.get_datasets()
+
+        collate_fn = self.get_collate_fn(batch_adapter)
+
+        train_loader = self.make_loader(train_set, collate_fn, shuffle=True, indexed=indexed, resumable=resumable,
+                                        **overrides)
+        # validation metrics are computed by the main process alone, so it gets the whole test set
+        test_loader = self.make_loader(test_set, collate_fn, shuffle=False, sharded=False, **overrides)
         return train_loader, test_loader
 
+    def make_loader(self, dataset, collate_fn, shuffle, batch_sampler=None, indexed=False, resumable=False,
+                    sharded=True, **overrides):
+        """
+        :param sharded: whether every data-parallel process gets its own share of the dataset
+        """
+        sharded = sharded and is_distributed()
+        loader_params = self.loader_params.copy()
+        loader_params.update(overrides)
+        kwargs = loader_kwargs(loader_params)
+
+        batch_sampler = batch_sampler or self.make_batch_sampler(dataset, shuffle)
+
+        if indexed:
+            # wrapped after the batch sampler is made, since it may look at examples
+            dataset = IndexedDataset(dataset)
+            collate_fn = IndexedCollator(collate_fn)
+        if batch_sampler and sharded:
+            # every data-parallel replica gets its own share of batches
+            batch_sampler = DistributedBatchSampler(batch_sampler)
+
+        read_ahead = can_read_ahead(dataset)
+        if (resumable or read_ahead) and not batch_sampler:
+            # same batches as DataLoader itself would make from batch_size and shuffle
+            batch_sampler = torch.utils.data.BatchSampler(self.make_sampler(dataset, shuffle, sharded),
+                                                          self.batch_size, drop_last=False)
+
+        if resumable:
+            batch_sampler = ResumableBatchSampler(batch_sampler)
+
+        if read_ahead:
+            # batches are announced to the dataset as the loader draws them, ahead of the workers reading them
+            batch_sampler = ReadAheadBatchSampler(batch_sampler, dataset)
+
+        if batch_sampler:
+            return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn,
+                                               **kwargs)
+
+        if sharded:
+            sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+            return torch.utils.data.DataLoader(dataset, batch_size=self.batch_size, sampler=sampler,
+                                               collate_fn=collate_fn, **kwargs)
+
+        return torch.utils.data.DataLoader(dataset, batch_size=self.batch_size, shuffle=shuffle,
+                                           collate_fn=collate_fn, **kwargs)
+
+    def make_sampler(self, dataset, shuffle, sharded=True):
+        if sharded and is_distributed():
+            return torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+        if shuffle:
+            return ShuffledSampler(dataset)
+        return torch.utils.data.SequentialSampler(dataset)
+
+    def make_batch_sampler(self, dataset, shuffle):
+        """Returns a batch sampler specified in "batch_sampler" section of data config or None"""
+        if not self.batch_sampler:
+            return None
+
+        args = self.batch_sampler.get("args", [])
+        kwargs = self.batch_sampler.get("kwargs", {})
+        return instantiate_class(self.batch_sampler["class"], dataset, self.batch_size, shuffle, *args, **kwargs)
+
+    def get_collate_fn(self, batch_adapter=None):
+        """Returns a function used by DataLoader workers to form batches.
+
+        When adapt_in_workers is set, batch adapter is composed into the collator, so that
+        batches arrive already split into a dictionary with "inputs" and "targets" keys.
+        """
+        if self.adapt_in_workers and batch_adapter:
+            return AdaptedCollator(self.collator, batch_adapter)
+        return self.collator
+
     def process_raw_input(self, raw_data, input_adapter):
         ds = [input_adapter(raw_data)]
         if self.preprocessors:
@@ -114,7 +212,11 @@ class DataPipeline:
             'preprocessors': [p.to_dict() for p in self.preprocessors],
             'collator': self.collator.to_dict(),
             'batch_size': self.batch_size,
-            'device_str': self.device_str
+            'device_str': self.device_str,
+            'adapt_in_workers': self.adapt_in_workers,
+            'loader_params': self.loader_params,
+            'example_cache_dir': self.example_cache_dir,
+            'batch_sampler': self.batch_sampler
         }
 
     @classmethod
@@ -135,6 +237,10 @@ class DataPipeline:
 
         batch_size = config_dict["data"]["batch_size"]
         device_str = config_dict["training"].get("device", "cpu")
+        adapt_in_workers = config_dict["data"].get("adapt_in_workers", False)
+        loader_params = config_dict["data"].get("loader", {})
+        example_cache_dir = config_dict["data"].get("example_cache_dir")
+        batch_sampler = config_dict["data"].get("batch_sampler")
 
         ds_name = config_dict["data"]["dataset_name"]
 
@@ -150,7 +256,9 @@ class DataPipeline:
 
         return DataPipeline(dataset=ds, transform=transform, splitter=splitter,
                             preprocessors=preprocessors, collator=collate_fn,
-                            batch_size=batch_size, device_str=device_str)
+                            batch_size=batch_size, device_str=device_str,
+                            adapt_in_workers=adapt_in_workers, loader_params=loader_params,
+                            example_cache_dir=example_cache_dir, batch_sampler=batch_sampler)
 
     @classmethod
     def from_dict(cls, state_dict):
@@ -163,7 +271,12 @@ class DataPipeline:
         collator = GenericSerializableInstance.from_dict(state_dict['collator'])
         batch_size = state_dict['batch_size']
         device_str = state_dict['device_str']
-        return cls(dataset, transform, splitter, preprocessors, collator, batch_size, device_str)
+        adapt_in_workers = state_dict.get('adapt_in_workers', False)
+        loader_params = state_dict.get('loader_params')
+        example_cache_dir = state_dict.get('example_cache_dir')
+        batch_sampler = state_dict.get('batch_sampler')
+        return cls(dataset, transform, splitter, preprocessors, collator, batch_size, device_str,
+                   adapt_in_workers, loader_params, example_cache_dir, batch_sampler)
 
 
 class LoaderWithDevice:
@@ -177,6 +290,41 @@ class LoaderWithDevice:
             yield batch
 
 
+default_loader_params = {
+    'num_workers': 2,
+    'pin_memory': False,
+    'prefetch_factor': 2,
+    'persistent_workers': True,
+    'multiprocessing_context': None
+}
+
+
+def parse_loader_params(loader_dict):
+    """Returns DataLoader parameters from the "loader" section of data config filled with defaults
+
+    Key "autotune" is not a DataLoader parameter and is left out
+    """
+    unknown_params = set(loader_dict) - set(default_loader_params) - {'autotune'}
+    if unknown_params:
+        raise InvalidParameterError(f'Unknown data loader parameters: {sorted(unknown_params)}. '
+                                    f'Must be one of {list(default_loader_params.keys())}')
+
+    loader_params = default_loader_params.copy()
+    loader_params.update({k: v for k, v in loader_dict.items() if k != 'autotune'})
+    return loader_params
+
+
+def loader_kwargs(loader_params):
+    """Converts loader parameters into keyword arguments accepted by DataLoader"""
+    kwargs = loader_params.copy()
+    if not kwargs['num_workers']:
+        # these parameters are only allowed when data is loaded in worker processes
+        del kwargs['prefetch_factor']
+        del kwargs['persistent_workers']
+        del kwargs['multiprocessing_context']
+    return kwargs
+
+
 def build_data_split(data_dict, splitter):
     ds_class_name = data_dict["dataset_name"]
 
@@ -296,7 +444,38 @@ def parse_single_metric(metric_name, metric_dict, data_pipeline, device):
 
 def parse_model(config_dict):
     model_config = config_dict["training"]["model"]
-    return [parse_submodel(config) for config in model_config]
+    nodes = [parse_submodel(config) for config in model_config]
+    check_cached_nodes(nodes)
+    return nodes
+
+
+def check_cached_nodes(nodes):
+    """Makes sure that nodes caching their outputs do not depend on outputs of trainable nodes,
+    which change during training and would make cached outputs stale
+    """
+    producers = {name: node for node in nodes for name in node.outputs}
+
+    def trainable_ancestor(node, visited):
+        for name in node.inputs:
+            producer = producers.get(name)
+            if producer is None or producer.name in visited:
+                continue
+            if not producer.frozen:
+                return producer
+            ancestor = trainable_ancestor(producer, visited | {producer.name})
+            if ancestor:
+                return ancestor
+        return None
+
+    for node in nodes:
+        if not node.cache_outputs:
+            continue
+
+        ancestor = trainable_ancestor(node, {node.name})
+        if ancestor:
+            raise InvalidParameterError(
+                f'Node "{node.name}" can not cache outputs: it depends on outputs of trainable node "{ancestor.name}"'
+            )
 
 
 def parse_submodel(config):
@@ -314,9 +493,109 @@ def parse_submodel(config):
         optimizer_config, instantiate_fn, wrapper_class=SerializableOptimizer
     )
 
+    frozen = config.get("frozen", False)
+    cache_outputs = parse_cache_outputs(config.get("cache_outputs"), config["outputs"])
+    if cache_outputs and not frozen:
+        raise InvalidParameterError(
+            f'Node "{config["name"]}" can not cache outputs: only outputs of frozen nodes stay the same'
+        )
+
     return Node(name=config["name"], serializable_model=serializable_model,
                 serializable_optimizer=serializable_optimizer,
-                inputs=config["inputs"], outputs=config["outputs"])
+                inputs=config["inputs"], outputs=config["outputs"], frozen=frozen, cache_outputs=cache_outputs,
+                compile_options=parse_compile_options(config.get("compile")),
+                activation_checkpointing=parse_activation_checkpointing(config.get("activation_checkpointing")))
+
+
+def parse_cache_outputs(cache_config, outputs):
+    """Parses "cache_outputs" option of a node
+
+    :param cache_config: either true or a dictionary {"batch_dims": {output_name: dim}} giving the batch dimension
+    of outputs whose batch dimension is not 0 (e.g. hidden states of recurrent layers of shape (num_layers, B, H))
+    :param outputs: names of outputs of the node
+    :return: a dictionary of options or None when caching is off
+    """
+    if not cache_config:
+        return None
+
+    if cache_config is True:
+        return {"batch_dims": {}}
+
+    unknown = set(cache_config) - {"batch_dims"}
+    if unknown:
+        raise InvalidParameterError(f'Unknown "cache_outputs" options: {sorted(unknown)}')
+
+    batch_dims = cache_config.get("batch_dims", {})
+    unknown = set(batch_dims) - set(outputs)
+    if unknown:
+        raise InvalidParameterError(f'"batch_dims" refers to unknown outputs: {sorted(unknown)}')
+
+    for name, dim in batch_dims.items():
+        if not isinstance(dim, int) or dim < 0:
+            raise InvalidParameterError(f'Batch dimension of "{name}" must be a non-negative integer, got {dim}')
+
+    return {"batch_dims": dict(batch_dims)}
+
+
+def parse_activation_checkpointing(checkpointing_config):
+    """Parses "activation_checkpointing" option of a node
+
+    :param checkpointing_config: either a dictionary {"container": name, "every": n}, which selects every n-th child
+    of a submodule (the model itself when "container" is omitted), or {"modules": [name1, name2, ...]}
+    with names of submodules as in named_modules()
+    :return: a dictionary of options or None when activation checkpointing is off
+    """
+    if not checkpointing_config:
+        return None
+
+    if "modules" in checkpointing_config:
+        if set(checkpointing_config) != {"modules"}:
+            raise InvalidParameterError('"modules" can not be combined with other activation checkpointing options')
+        return {"modules": list(checkpointing_config["modules"])}
+
+    unknown = set(checkpointing_config) - {"container", "every"}
+    if unknown:
+        raise InvalidParameterError(f'Unknown activation checkpointing options: {sorted(unknown)}')
+
+    every = checkpointing_config.get("every", 1)
+    if not isinstance(every, int) or every < 1:
+        raise InvalidParameterError(f'"every" must be a positive integer, got {every}')
+
+    return {"container": checkpointing_config.get("container", ""), "every": every}
+
+
+compile_modes = ["default", "reduce-overhead", "max-autotune", "max-autotune-no-cudagraphs"]
+
+
+def parse_compile_options(compile_config):
+    """Parses "compile" option of a node
+
+    :param compile_config: either a boolean, a name of a compile mode or a dictionary with optional keys
+    "mode", "fullgraph" (whether a graph break is an error) and "fallback" (whether to run the node in eager mode
+    when compilation fails)
+    :return: a dictionary of options or None when the node is not compiled
+    """
+    if not compile_config:
+        return None
+
+    if compile_config is True:
+        compile_config = {}
+    elif isinstance(compile_config, str):
+        compile_config = {"mode": compile_config}
+
+    unknown = set(compile_config) - {"mode", "fullgraph", "fallback"}
+    if unknown:
+        raise InvalidParameterError(f'Unknown compile options: {sorted(unknown)}')
+
+    options = {
+        "mode": compile_config.get("mode", "default"),
+        "fullgraph": compile_config.get("fullgraph", False),
+        "fallback": compile_config.get("fallback", True)
+    }
+
+    if options["mode"] not in compile_modes:
+        raise InvalidParameterError(f'Unknown compile mode "{options["mode"]}". Must be one of {compile_modes}')
+    return options
 
 
 def parse_loss(loss_config, device):
@@ -330,8 +609,20 @@ def parse_loss(loss_config, device):
     criterion_class = getattr(nn, loss_class_name)
     args = loss_config.get("args", [])
     kwargs = loss_config.get("kwargs", {})
+    criterion = criterion_class(*args, **kwargs)
 
-    return Metric('loss', criterion_class(*args, **kwargs), loss_config["inputs"], transform_fn, device)
+    if "ignore_padding" in loss_config:
+        if not hasattr(criterion, 'ignore_index'):
+            raise InvalidParameterError(
+                f'Loss "{loss_class_name}" does not support ignore_index, so it can not ignore padding'
+            )
+
+        padding_config = loss_config["ignore_padding"]
+        return MaskedMetric('loss', criterion, loss_config["inputs"], transform_fn, device,
+                            target_name=padding_config["target"], lengths_name=padding_config["lengths"],
+                            ignore_index=criterion.ignore_index)
+
+    return Metric('loss', criterion, loss_config["inputs"], transform_fn, device)
 
 
 def parse_device(config_dict):
@@ -339,6 +630,111 @@ def parse_device(config_dict):
     return torch.device(device_str)
 
 
+training_modes = ["normal", "hogwild", "pipeline_parallel"]
+
+
+def parse_training_mode(training_config):
+    """Returns a training mode and a number of worker processes it uses"""
+    mode = training_config.get("mode", "normal")
+    if mode not in training_modes:
+        raise InvalidParameterError(f'Unknown training mode "{mode}". Must be one of {training_modes}')
+
+    default_processes = (os.cpu_count() or 1) if mode == "hogwild" else 1
+    return mode, training_config.get("num_processes", default_processes)
+
+
+def parse_pipeline_parallel(training_config):
+    """Returns keyword arguments of PipelineParallelTrainer given in "pipeline_parallel" section"""
+    pipeline_config = training_config.get("pipeline_parallel", {})
+    unknown = set(pipeline_config) - {"num_micro_batches", "batch_dims"}
+    if unknown:
+        raise InvalidParameterError(f'Unknown pipeline parallel parameters: {sorted(unknown)}')
+
+    return {
+        "num_micro_batches": pipeline_config.get("num_micro_batches", 4),
+        "batch_dims": pipeline_config.get("batch_dims", {})
+    }
+
+
+def parse_accumulation_steps(training_config):
+    accumulation_steps = training_config.get("accumulation_steps", 1)
+    if not isinstance(accumulation_steps, int) or accumulation_steps < 1:
+        raise InvalidParameterError(
+            f'"accumulation_steps" must be a positive integer, got {accumulation_steps}'
+        )
+    return accumulation_steps
+
+
+precisions = ["fp32", "bf16"]
+
+
+def parse_precision(training_config):
+    precision = training_config.get("precision", "fp32")
+    if precision not in precisions:
+        raise InvalidParameterError(f'Unknown precision "{precision}". Must be one of {precisions}')
+    return precision
+
+
+def parse_mid_epoch_checkpoints(training_config):
+    """Parses optional "mid_epoch_checkpoints" section, e.g. {"every_iterations": 500, "every_seconds": 1800}
+
+    A checkpoint is made whenever either interval has passed since the last one.
+    """
+    options = training_config.get("mid_epoch_checkpoints")
+    if options is None:
+        return None
+
+    unknown = set(options) - {"every_iterations", "every_seconds"}
+    if unknown:
+        raise InvalidParameterError(f'Unknown mid-epoch checkpoint options: {sorted(unknown)}')
+
+    if not options:
+        raise InvalidParameterError('"mid_epoch_checkpoints" needs "every_iterations" or "every_seconds"')
+
+    for key, value in options.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise InvalidParameterError(f'"{key}" must be a positive number, got {value}')
+
+    if training_config.get("mode") == "hogwild":
+        raise InvalidParameterError('Mid-epoch checkpoints are not supported in "hogwild" mode')
+
+    return {"every_iterations": options.get("every_iterations"), "every_seconds": options.get("every_seconds")}
+
+
+def parse_retention(training_config):
+    """Parses optional "retention" policy of checkpoints, e.g.
+    {"keep_last": 3, "keep_best": 2, "metric": "val loss", "mode": "min"}
+
+    Metric names are the ones in history.csv (validation metrics are prefixed with "val ").
+    """
+    retention = training_config.get("retention")
+    if retention is None:
+        return None
+
+    unknown = set(retention) - {"keep_last", "keep_best", "metric", "mode"}
+    if unknown:
+        raise InvalidParameterError(f'Unknown retention options: {sorted(unknown)}')
+
+    for key in ["keep_last", "keep_best"]:
+        value = retention.get(key)
+        if value is not None and (not isinstance(value, int) or value < 1):
+            raise InvalidParameterError(f'"{key}" must be a positive integer, got {value}')
+
+    if retention.get("keep_best") and not retention.get("metric"):
+        raise InvalidParameterError('"keep_best" requires a "metric" to compare checkpoints by')
+
+    mode = retention.get("mode", "min")
+    if mode not in ["min", "max"]:
+        raise InvalidParameterError(f'"mode" must be either "min" or "max", got "{mode}"')
+
+    return {
+        "keep_last": retention.get("keep_last"),
+        "keep_best": retention.get("keep_best"),
+        "metric": retention.get("metric"),
+        "mode": mode
+    }
+
+
 def parse_epochs(config_dict):
     return config_dict["training"]["num_epochs"]
 
@@ -348,12 +744,37 @@ def parse_checkpoint_dir(config_dict):
 
 
 class Node:
-    def __init__(self, name, serializable_model, serializable_optimizer, inputs, outputs):
+    def __init__(self, name, serializable_model, serializable_optimizer, inputs, outputs,
+                 frozen=False, cache_outputs=False, compile_options=None, activation_checkpointing=None):
+        """
+        :param frozen: whether the node is excluded from training (no gradients, no optimizer steps)
+        :param cache_outputs: options of caching of outputs of a frozen node, which are then computed once
+        per training example and read from a feature cache (see FeatureCache and parse_cache_outputs)
+        :param compile_options: options of torch.compile returned by parse_compile_options or None
+        :param activation_checkpointing: options returned by parse_activation_checkpointing or None
+        """
         self.name = name
         self.net = serializable_model
         self.optimizer = serializable_optimizer
         self.inputs = inputs
         self.outputs = outputs
+        self.frozen = frozen
+        self.cache_outputs = cache_outputs
+        self.compile_options = compile_options
+
+        # set by the training loop when cache_outputs is True
+        self.feature_cache = None
+
+        # set by compile_nodes when compile_options are given
+        self.compiled = None
+
+        if frozen:
+            for param in serializable_model.instance.parameters():
+                param.requires_grad_(False)
+
+        self.activation_checkpointing = activation_checkpointing
+        if activation_checkpointing:
+            enable_activation_checkpointing(serializable_model.instance, activation_checkpointing)
 
     def get_dependencies(self, batch_inputs, prev_outputs):
         lookup_table = batch_inputs[self.name].copy()
@@ -362,14 +783,58 @@ class Node:
 
     def predict(self, *args, inference_mode=False):
         # todo: consider to change args device here (need to store device as attribute)
+        net = self.compiled or self.net
         if inference_mode:
-            return self.net.run_inference(*args)
+            return net.run_inference(*args)
         else:
-            return self.net(*args)
+            return net(*args)
+
+    def __call__(self, batch_inputs, prev_outputs, inference_mode=False, indices=None):
+        """
+        :param indices: optional dataset indices of examples of a batch, used to look up cached outputs
+        """
+        use_cache = self.feature_cache is not None and indices is not None
+        if use_cache:
+            outputs = self.feature_cache.get(indices)
+            if outputs is not None:
+                return outputs
 
-    def __call__(self, batch_inputs, prev_outputs, inference_mode=False):
         args = self.get_dependencies(batch_inputs, prev_outputs)
-        return self.predict(*args, inference_mode=inference_mode)
+
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not self.frozen):
+            outputs = self.predict(*args, inference_mode=inference_mode)
+
+        if use_cache:
+            self.feature_cache.put(indices, outputs)
+        return outputs
+
+
+def assign_state_dict(model, state_dict):
+    """Makes parameters and buffers of a model use tensors of a state dict without copying them
+    (for PyTorch versions whose load_state_dict has no "assign" argument)
+
+    Tensors of a different shape or data type than the ones of the model are copied as usual.
+    """
+    expected = set(model.state_dict())
+    if set(state_dict) != expected:
+        # reports missing and unexpected keys like strict loading does
+        model.load_state_dict(state_dict)
+        return
+
+    for name, module in model.named_modules():
+        prefix = f'{name}.' if name else ''
+        tensors = list(module._parameters.items()) + list(module._buffers.items())
+        for attr, tensor in tensors:
+            key = f'{prefix}{attr}'
+            if tensor is None or key not in state_dict:
+                continue
+
+            value = state_dict[key]
+            if value.shape == tensor.shape and value.dtype == tensor.dtype:
+                tensor.data = value
+            else:
+                with torch.no_grad():
+                    tensor.copy_(value)
 
 
 class SerializableModel(DecoratedInstance):
@@ -382,12 +847,21 @@ class SerializableModel(DecoratedInstance):
         }
 
     @classmethod
-    def from_dict(cls, d):
+    def from_dict(cls, d, assign=False):
+        """
+        :param assign: whether the model takes tensors of the state dict as its parameters instead of
+        copying them (keeps memory-mapped tensors mapped), ignored by PyTorch versions not supporting it
+        """
         model_class_path = d['model_class']
         args = d['model_args']
         kwargs = d['model_kwargs']
         model = instantiate_class(model_class_path, *args, **kwargs)
-        model.load_state_dict(d['model_state_dict'])
+        if assign and 'assign' in inspect.signature(model.load_state_dict).parameters:
+            model.load_state_dict(d['model_state_dict'], assign=True)
+        elif assign:
+            assign_state_dict(model, d['model_state_dict'])
+        else:
+            model.load_state_dict(d['model_state_dict'])
 
         return cls(instance=model, class_name=model_class_path, args=args, kwargs=kwargs)
 
@@ -0,0 +1,229 @@
+import queue
+import threading
+from contextlib import nullcontext
+
+import torch
+
+
+# put into queues of neighbouring stages when a stage fails, so that they stop waiting
+stop_signal = object()
+
+
+def micro_batch_sizes(batch_size, num_micro_batches):
+    num_micro_batches = max(1, min(batch_size, num_micro_batches))
+    size, remainder = divmod(batch_size, num_micro_batches)
+    return [size + 1 if i < remainder else size for i in range(num_micro_batches)]
+
+
+def find_batch_size(mapping, batch_dims):
+    for name, value in mapping.items():
+        if isinstance(value, torch.Tensor) and value.dim() > 0:
+            return value.size(batch_dims.get(name, 0))
+        if isinstance(value, (list, tuple)):
+            return len(value)
+    raise ValueError('Can not determine batch size: batch has neither tensors nor lists')
+
+
+def split_value(value, sizes, dim):
+    if isinstance(value, torch.Tensor) and value.dim() > 0:
+        return list(value.split(sizes, dim=dim))
+
+    if isinstance(value, (list, tuple)):
+        offsets = [sum(sizes[:i]) for i in range(len(sizes) + 1)]
+        return [value[start:stop] for start, stop in zip(offsets, offsets[1:])]
+
+    # scalars and None are shared by all micro-batches
+    return [value] * len(sizes)
+
+
+def split_mapping(mapping, sizes, batch_dims):
+    """Splits every value of a dictionary into micro-batches, returns a list of dictionaries"""
+    parts = {name: split_value(value, sizes, batch_dims.get(name, 0)) for name, value in mapping.items()}
+    return [{name: parts[name][i] for name in mapping} for i in range(len(sizes))]
+
+
+def merge_values(values, dim):
+    first = values[0]
+    if isinstance(first, torch.Tensor) and first.dim() > 0:
+        return torch.cat(values, dim=dim)
+
+    if isinstance(first, (list, tuple)):
+        return [item for value in values for item in value]
+
+    return first
+
+
+def split_batch(inputs, targets, num_micro_batches, batch_dims):
+    """Splits an adapted batch into micro-batches
+
+    :param inputs: inputs of a batch (a dictionary mapping node names to dictionaries of values)
+    :param targets: targets of a batch
+    :param num_micro_batches: desired number of micro-batches (smaller batches produce fewer of them)
+    :param batch_dims: dictionary mapping names of values to their batch dimension (0 by default)
+    :return: a list of (inputs, targets, fraction of examples) tuples
+    """
+    first_node_inputs = next(iter(inputs.values()))
+    batch_size = find_batch_size(first_node_inputs, batch_dims)
+    sizes = micro_batch_sizes(batch_size, num_micro_batches)
+
+    split_inputs = {node_name: split_mapping(mapping, sizes, batch_dims) for node_name, mapping in inputs.items()}
+    split_targets = split_mapping(targets or {}, sizes, batch_dims)
+
+    return [({node_name: parts[i] for node_name, parts in split_inputs.items()}, split_targets[i], size / batch_size)
+            for i, size in enumerate(sizes)]
+
+
+def weigh_micro_batches(micro_batches, loss_fn):
+    """Replaces fractions of examples of micro-batches with weights of their losses
+
+    Weighted losses of micro-batches add up to the loss of the whole batch: losses summed over
+    elements keep weight 1, averaged ones are weighted by the share of elements they are averaged
+    over (e.g. tokens which are not padding). When loss_fn can not tell it, shares of examples are used.
+
+    :param micro_batches: list of (inputs, targets, fraction) tuples returned by split_batch
+    :param loss_fn: loss function, optionally having normalizer method (see Metric.normalizer)
+    :return: a list of (inputs, targets, weight) tuples
+    """
+    if getattr(loss_fn, 'reduction', 'mean') == 'sum':
+        return [(inputs, targets, 1.) for inputs, targets, _ in micro_batches]
+
+    normalizer = getattr(loss_fn, 'normalizer', None)
+    counts = [normalizer(targets) for _, targets, _ in micro_batches] if normalizer else [None]
+    if None in counts or sum(counts) == 0:
+        return micro_batches
+
+    total = sum(counts)
+    return [(inputs, targets, count / total) for (inputs, targets, _), count in zip(micro_batches, counts)]
+
+
+def detach_boundary(value):
+    """Cuts autograd graph at the boundary of a stage, gradient w.r.t. the value gets accumulated in its grad"""
+    if isinstance(value, torch.Tensor) and value.requires_grad:
+        return value.detach().requires_grad_()
+    return value
+
+
+def run_pipeline_parallel(nodes, micro_batches, loss_fn, batch_dims, node_context=None, indices=None):
+    """Runs forward and backward passes over micro-batches with every node working in its own thread
+
+    Stages form a chain: a stage passes outputs of all preceding nodes and its own outputs to the next one.
+    Stage k runs forward pass on micro-batch i while stage k + 1 works on micro-batch i - 1. The last stage
+    computes the loss and runs backward pass right away, sending gradients w.r.t. its inputs upstream.
+    Other stages run backward passes once they are done with forward passes (GPipe schedule).
+    Gradients of all micro-batches are accumulated in parameters of nodes.
+
+    :param nodes: list of nodes of a prediction pipeline
+    :param micro_batches: list of (inputs, targets, weight of the loss) tuples returned by split_batch
+    or weigh_micro_batches
+    :param loss_fn: loss function taking (outputs, targets)
+    :param batch_dims: dictionary mapping names of values to their batch dimension (0 by default)
+    :param node_context: optional function returning a context manager entered around every call
+    of a node (e.g. autocast, whose state is local to a thread)
+    :param indices: optional list with dataset indices of examples of every micro-batch, passed to nodes
+    (see Node.__call__)
+    :return: a tuple (loss, outputs) for the whole batch, both detached from autograd graph
+    """
+    num_stages = len(nodes)
+    num_micro_batches = len(micro_batches)
+
+    forward_queues = [queue.Queue() for _ in range(num_stages)]
+    backward_queues = [queue.Queue() for _ in range(num_stages)]
+    results = [None] * num_micro_batches
+    errors = []
+
+    def stop_neighbours(stage):
+        if stage + 1 < num_stages:
+            forward_queues[stage + 1].put(stop_signal)
+        if stage > 0:
+            backward_queues[stage - 1].put(stop_signal)
+
+    def send_gradients(stage, i, grads, boundary):
+        for name, value in boundary.items():
+            if isinstance(value, torch.Tensor) and value.grad is not None:
+                grads[name] = grads[name] + value.grad if name in grads else value.grad
+
+        if stage > 0:
+            backward_queues[stage - 1].put((i, grads))
+
+    def run_stage(stage, node):
+        is_last = stage == num_stages - 1
+        saved = {}
+
+        for _ in range(num_micro_batches):
+            message = forward_queues[stage].get()
+            if message is stop_signal:
+                stop_neighbours(stage)
+                return
+
+            i, prev_outputs = message
+            inputs, targets, weight = micro_batches[i]
+
+            boundary = {name: detach_boundary(value) for name, value in prev_outputs.items()}
+            with node_context() if node_context else nullcontext():
+                if indices is None:
+                    outputs = dict(zip(node.outputs, node(inputs, boundary)))
+                else:
+                    outputs = dict(zip(node.outputs, node(inputs, boundary, indices=indices[i])))
+            all_outputs = dict(boundary, **outputs)
+
+            if is_last:
+                # weighted losses of micro-batches add up to the loss of the batch
+                if weight:
+                    loss = loss_fn(all_outputs, targets) * weight
+                    loss.backward()
+                else:
+                    # nothing to average over (e.g. only padding), the loss would be NaN
+                    loss = torch.zeros(())
+                results[i] = (loss.detach(), {name: v.detach() if isinstance(v, torch.Tensor) else v
+                                              for name, v in all_outputs.items()})
+                send_gradients(stage, i, {}, boundary)
+            else:
+                saved[i] = (boundary, outputs)
+                forward_queues[stage + 1].put((i, all_outputs))
+
+        if is_last:
+            return
+
+        for _ in range(num_micro_batches):
+            message = backward_queues[stage].get()
+            if message is stop_signal:
+                stop_neighbours(stage)
+                return
+
+            i, grads = message
+            boundary, outputs = saved.pop(i)
+
+            own = [(outputs[name], grads.pop(name)) for name in list(grads) if name in outputs]
+            if own:
+                tensors, tensor_grads = zip(*own)
+                torch.autograd.backward(tensors, tensor_grads)
+
+            send_gradients(stage, i, grads, boundary)
+
+    def stage_target(stage, node):
+        try:
+            run_stage(stage, node)
+        except BaseException as e:
+            errors.append(e)
+            stop_neighbours(stage)
+
+    threads = [threading.Thread(target=stage_target, args=(stage, node), daemon=True)
+               for stage, node in enumerate(nodes)]
+
+    for thread in threads:
+        thread.start()
+
+    for i in range(num_micro_batches):
+        forward_queues[0].put((i, {}))
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    loss = sum(micro_loss for micro_loss, _ in results)
+    output_names = results[0][1].keys()
+    outputs = {name: merge_values([micro_outputs[name] for _, micro_outputs in results], batch_dims.get(name, 0))
+               for name in output_names}
+    return loss, outputs
@@ -0,0 +1,95 @@
+import random
+
+import numpy as np
+import torch
+
+
+def get_rng_states():
+    """Returns states of all random number generators used during training"""
+    states = {
+        'torch': torch.get_rng_state(),
+        'numpy': np.random.get_state(),
+        'random': random.getstate()
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['random'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+class ShuffledSampler(torch.utils.data.Sampler):
+    """Random permutation of dataset indices determined by a seed and an epoch number only
+
+    Unlike RandomSampler, it does not draw from the global random number generator, so the order
+    of examples of an epoch can be reproduced when the epoch is resumed.
+    """
+    def __init__(self, dataset, seed=0):
+        self.num_examples = len(dataset)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(self.num_examples, generator=generator).tolist())
+
+    def __len__(self):
+        return self.num_examples
+
+
+class ResumableBatchSampler:
+    """Batch sampler able to start an epoch from a given batch
+
+    Skipped batches are only drawn from the wrapped sampler, so examples of them are never read.
+    The wrapped sampler must produce the same batches for the same epoch (see ShuffledSampler).
+    Its length is the length of a full epoch.
+    """
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.skip = 0
+        self.rng_states = None
+
+    def __getattr__(self, attr):
+        if attr == 'batch_sampler':
+            raise AttributeError(attr)
+        return getattr(self.batch_sampler, attr)
+
+    def resume(self, num_batches, rng_states=None):
+        """Makes the next pass start after num_batches batches
+
+        :param rng_states: states of random number generators (see get_rng_states) restored once
+        the batches are skipped, that is after the sampler has drawn its own random numbers
+        """
+        self.skip = num_batches
+        self.rng_states = rng_states
+
+    def set_epoch(self, epoch):
+        for sampler in [self.batch_sampler, getattr(self.batch_sampler, 'sampler', None)]:
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        skip, rng_states = self.skip, self.rng_states
+        self.skip, self.rng_states = 0, None
+
+        batches = iter(self.batch_sampler)
+        for _ in range(skip):
+            next(batches, None)
+
+        if rng_states:
+            set_rng_states(rng_states)
+
+        yield from batches
+
+    def __len__(self):
+        return len(self.batch_sampler)
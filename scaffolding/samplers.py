@@ -0,0 +1,176 @@
+from bisect import bisect_left
+
+import torch
+from torch.utils.data import Sampler, Subset
+
+from scaffolding.utils import DatasetSlice, WrappedDataset
+
+
+def example_length(value, length_dim=-1):
+    if isinstance(value, torch.Tensor):
+        return value.size(length_dim) if value.dim() > 0 else 1
+    if hasattr(value, '__len__'):
+        return len(value)
+    return 1
+
+
+known_lengths = {}
+
+
+def dataset_lengths(dataset, length_index=0, length_dim=-1):
+    """Returns lengths of a given element of all examples of a dataset
+
+    Datasets may provide them without decoding examples through a lengths(length_index, length_dim)
+    method (e.g. CachedDataset, ShardedDataset), also when wrapped (see provided_lengths). Otherwise every
+    example is read once. The result is kept under dataset's lengths_key (see DataPipeline.get_datasets),
+    so that datasets built later from the same data and preprocessors reuse it, or on the dataset object.
+    """
+    lengths = provided_lengths(dataset, length_index, length_dim)
+    if lengths is not None:
+        return lengths
+
+    lengths_key = getattr(dataset, 'lengths_key', None)
+    cache = known_lengths if lengths_key else dataset.__dict__.setdefault('known_lengths', {})
+    key = (lengths_key, length_index, length_dim)
+    if key not in cache:
+        cache[key] = [example_length(dataset[i][length_index], length_dim) for i in range(len(dataset))]
+    return cache[key]
+
+
+def provided_lengths(dataset, length_index=0, length_dim=-1):
+    """Returns lengths given by lengths() method of a dataset or of a dataset wrapped by it, None if there is none
+
+    Slices and subsets translate indices, WrappedDataset passes through elements it does not preprocess.
+    """
+    if isinstance(dataset, (Subset, DatasetSlice)):
+        inner = dataset.dataset if isinstance(dataset, Subset) else dataset.ds
+        lengths = provided_lengths(inner, length_index, length_dim)
+        if lengths is None:
+            return None
+        if isinstance(dataset, Subset):
+            return [lengths[i] for i in dataset.indices]
+        return lengths[dataset.index_from:dataset.index_to]
+
+    if isinstance(dataset, WrappedDataset):
+        if length_index < len(dataset.preprocessors):
+            # preprocessors may change lengths
+            return None
+        return provided_lengths(dataset.dataset, length_index, length_dim)
+
+    if callable(getattr(dataset, 'lengths', None)):
+        return dataset.lengths(length_index, length_dim)
+    return None
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler forming batches out of examples of similar length
+
+    Examples are distributed among buckets by their length: bucket i holds examples whose length
+    is in range (boundaries[i - 1], boundaries[i]]; the last bucket holds examples longer than
+    the last boundary. Batches are formed within a bucket, which keeps padding to a minimum.
+    Fraction of padded elements in produced batches is tracked in padding_waste attribute.
+    """
+    def __init__(self, dataset, batch_size, shuffle, boundaries, length_index=0, length_dim=-1,
+                 drop_last=False, seed=0):
+        """
+        :param dataset: dataset whose examples are sampled
+        :param batch_size: maximum number of examples in a batch
+        :param shuffle: whether to shuffle examples within buckets and the order of batches
+        :param boundaries: sorted list of bucket boundaries
+        :param length_index: index of the element of an example whose length is measured
+        :param length_dim: dimension along which length of tensors is measured
+        :param drop_last: whether to drop the last incomplete batch of every bucket
+        :param seed: seed for shuffling (combined with the epoch number)
+        """
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.boundaries = boundaries
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        self.lengths = dataset_lengths(dataset, length_index, length_dim)
+
+        self.buckets = [[] for _ in range(len(boundaries) + 1)]
+        for idx, length in enumerate(self.lengths):
+            self.buckets[bisect_left(boundaries, length)].append(idx)
+
+        self.num_elements = 0
+        self.num_padded = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @property
+    def padding_waste(self):
+        """Fraction of padded elements among all elements of batches produced so far in this epoch"""
+        if self.num_elements == 0:
+            return 0.
+        return self.num_padded / self.num_elements
+
+    def make_batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = [bucket[i] for i in torch.randperm(len(bucket), generator=generator).tolist()]
+
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches
+
+    def __iter__(self):
+        batches = self.make_batches()
+        self.epoch += 1
+
+        self.num_elements = 0
+        self.num_padded = 0
+        for batch in batches:
+            lengths = [self.lengths[idx] for idx in batch]
+            self.num_elements += max(lengths) * len(lengths)
+            self.num_padded += max(lengths) * len(lengths) - sum(lengths)
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(bucket) // self.batch_size for bucket in self.buckets)
+        return sum((len(bucket) + self.batch_size - 1) // self.batch_size for bucket in self.buckets)
+
+
+class ReadAheadBatchSampler:
+    """Batch sampler announcing every batch to the dataset (see ShardedDataset.read_ahead) as it is drawn
+
+    DataLoader draws batches from its batch sampler in the main process ahead of the workers reading them
+    (up to prefetch_factor batches per worker), so the reads are already under way when the examples are fetched.
+    Page cache is shared among processes, so it works for the workers too.
+    """
+    def __init__(self, batch_sampler, dataset):
+        self.batch_sampler = batch_sampler
+        self.dataset = dataset
+
+    def __getattr__(self, attr):
+        if attr == 'batch_sampler':
+            raise AttributeError(attr)
+        return getattr(self.batch_sampler, attr)
+
+    def set_epoch(self, epoch):
+        for sampler in [self.batch_sampler, getattr(self.batch_sampler, 'sampler', None)]:
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+                return
+
+    def __iter__(self):
+        for batch in self.batch_sampler:
+            self.dataset.read_ahead(batch)
+            yield batch
+
+    def __len__(self):
+        return len(self.batch_sampler)
@@ -0,0 +1,127 @@
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import torch
+
+
+def build_dependencies(nodes):
+    """Returns a list with a set of indices of nodes that every node has to wait for
+
+    Node j depends on an earlier node i when j reads a value written by i. Besides that, j also waits for i
+    when j overwrites a value that i reads or writes, so that the result is the same as when nodes
+    run one after another in config order.
+    """
+    dependencies = []
+    for j, node in enumerate(nodes):
+        inputs, outputs = set(node.inputs), set(node.outputs)
+        dependencies.append({
+            i for i, earlier in enumerate(nodes[:j])
+            if outputs & set(earlier.inputs) or set(earlier.outputs) & (inputs | outputs)
+        })
+    return dependencies
+
+
+def last_producer(nodes, name, before):
+    for i in reversed(range(before)):
+        if name in nodes[i].outputs:
+            return i
+    return None
+
+
+def select_nodes(nodes, dependencies, required_outputs=None):
+    """Returns indices of nodes needed to compute required outputs (all nodes when required_outputs is None)
+
+    :param nodes: list of nodes of a pipeline
+    :param dependencies: result of build_dependencies(nodes)
+    :param required_outputs: names of values that must be computed
+    :return: a set of indices
+    """
+    if required_outputs is None:
+        return set(range(len(nodes)))
+
+    pending = [last_producer(nodes, name, len(nodes)) for name in required_outputs]
+    selected = set()
+    while pending:
+        j = pending.pop()
+        if j is None or j in selected:
+            continue
+
+        selected.add(j)
+        pending.extend(last_producer(nodes, name, j) for name in nodes[j].inputs)
+
+    return selected
+
+
+def value_readers(nodes, selected):
+    """Returns a dictionary mapping every value read by selected nodes to indices of nodes reading it"""
+    readers = {}
+    for j in selected:
+        for name in nodes[j].inputs:
+            readers.setdefault(name, set()).add(j)
+    return readers
+
+
+def run_graph(nodes, dependencies, selected, run_node, get_executor, keep=None):
+    """Runs selected nodes in dependency order, independent nodes run concurrently on a thread pool
+
+    When exactly one node is ready and nothing else is running, it runs in the calling thread,
+    so that chains of nodes pay nothing for scheduling.
+
+    :param nodes: list of nodes
+    :param dependencies: result of build_dependencies(nodes)
+    :param selected: indices of nodes to run
+    :param run_node: function taking (node, outputs computed so far) and returning a dictionary of new outputs
+    :param get_executor: function returning a thread pool executor (called only when it is needed)
+    :param keep: optional names of values to return; when given, every other value is released
+    as soon as all nodes reading it are done, which lowers peak memory (useful under torch.no_grad,
+    when intermediate tensors are not referenced by autograd graph)
+    :return: a dictionary with outputs of all nodes that were run (or only values from keep)
+    """
+    all_outputs = {}
+    done = set()
+    running = {}
+
+    readers = value_readers(nodes, selected) if keep is not None else {}
+
+    def release_dead_values():
+        for name in list(all_outputs):
+            if name not in keep and readers.get(name, set()) <= done:
+                del all_outputs[name]
+
+    # grad mode is thread local, so it has to be passed over to threads of the pool
+    grad_enabled = torch.is_grad_enabled()
+
+    def run_in_thread(node, prev_outputs):
+        with torch.set_grad_enabled(grad_enabled):
+            return run_node(node, prev_outputs)
+
+    def is_ready(j):
+        return j not in done and j not in running.values() and \
+            all(i in done or i not in selected for i in dependencies[j])
+
+    while len(done) < len(selected):
+        ready = [j for j in sorted(selected) if is_ready(j)]
+
+        if len(ready) == 1 and not running:
+            j = ready[0]
+            all_outputs.update(run_node(nodes[j], all_outputs))
+            done.add(j)
+            if keep is not None:
+                release_dead_values()
+            continue
+
+        for j in ready:
+            future = get_executor().submit(run_in_thread, nodes[j], dict(all_outputs))
+            running[future] = j
+
+        finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+
+        # outputs are merged in config order, as if nodes ran one after another
+        for future in sorted(finished, key=lambda f: running[f]):
+            j = running.pop(future)
+            all_outputs.update(future.result())
+            done.add(j)
+
+        if keep is not None:
+            release_dead_values()
+
+    return all_outputs
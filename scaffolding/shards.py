@@ -0,0 +1,200 @@
+import json
+import mmap
+import os
+import shutil
+
+import torch
+from torch.utils.data import Dataset
+
+from scaffolding.codecs import encode_value, decode_value, stored_length
+
+
+index_file = 'index.pt'
+meta_file = 'meta.json'
+
+
+def shard_name(shard_id):
+    return f'shard-{shard_id:05}.bin'
+
+
+class ShardWriter:
+    """Packs examples into binary shard files of (roughly) fixed size
+
+    Every element of an example is stored as raw bytes (see scaffolding.codecs). A shard is closed
+    as soon as its size reaches shard_size bytes, examples are never split across shards.
+    The index keeps, for each example, a shard id and (kind, offset, size, dtype, shape) records
+    for its elements.
+    """
+    def __init__(self, output_dir, shard_size=256 * 2 ** 20):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+
+        self.index = []
+        self.shard_id = -1
+        self.shard_file = None
+        self.offset = 0
+        self.single_values = False
+
+        os.makedirs(output_dir)
+
+    def write(self, example):
+        if not isinstance(example, (list, tuple)):
+            self.single_values = True
+            example = [example]
+
+        if self.shard_file is None or self.offset >= self.shard_size:
+            self.next_shard()
+
+        records = []
+        for value in example:
+            kind, dtype, shape, data = encode_value(value)
+            self.shard_file.write(data)
+            records.append((kind, self.offset, len(data), dtype, shape))
+            self.offset += len(data)
+
+        self.index.append((self.shard_id, records))
+
+    def next_shard(self):
+        if self.shard_file:
+            self.shard_file.close()
+
+        self.shard_id += 1
+        self.offset = 0
+        self.shard_file = open(os.path.join(self.output_dir, shard_name(self.shard_id)), 'wb')
+
+    def close(self):
+        if self.shard_file:
+            self.shard_file.close()
+
+        torch.save(self.index, os.path.join(self.output_dir, index_file))
+
+        meta = {
+            'num_examples': len(self.index),
+            'num_shards': self.shard_id + 1,
+            'shard_size': self.shard_size,
+            'single_values': self.single_values
+        }
+        with open(os.path.join(self.output_dir, meta_file), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(meta))
+
+
+def convert_to_shards(dataset, output_dir, shard_size=256 * 2 ** 20):
+    """Writes all examples of a dataset into shards under output_dir
+
+    Shards are written into a temporary directory which is renamed once conversion is complete.
+    """
+    tmp_dir = f'{output_dir}.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+    writer = ShardWriter(tmp_dir, shard_size)
+    for i in range(len(dataset)):
+        writer.write(dataset[i])
+    writer.close()
+
+    os.replace(tmp_dir, output_dir)
+
+
+class ShardedDataset(Dataset):
+    """Dataset reading examples from shards produced by convert_to_shards
+
+    Can be used as "dataset_name" with "dataset_kwargs": {"path": <shards directory>}.
+    Shards are memory-mapped. Data loaders announce every batch before reading it (see ReadAheadBatchSampler),
+    and the kernel is asked to read bytes of all of its examples at once, which lets it issue the reads together
+    instead of faulting pages in one example at a time, whatever the order of examples.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        self.index = torch.load(os.path.join(path, index_file))
+
+        with open(os.path.join(path, meta_file), encoding='utf-8') as f:
+            self.meta = json.loads(f.read())
+
+        self.shards = {}
+
+    def __getitem__(self, idx):
+        if not (0 <= idx < len(self)):
+            raise IndexError(f'ShardedDataset: Index out of bounds: {idx}')
+
+        shard_id, records = self.index[idx]
+        shard = self.get_shard(shard_id)
+
+        example = [decode_value(shard[offset:offset + num_bytes], kind, dtype, shape)
+                   for kind, offset, num_bytes, dtype, shape in records]
+
+        if self.meta['single_values']:
+            return example[0]
+        return tuple(example)
+
+    def __len__(self):
+        return len(self.index)
+
+    def lengths(self, length_index=0, length_dim=-1):
+        """Returns lengths of a given element of all examples, reading only the index when possible
+
+        Returns None for shards of single values, whose examples are not tuples of elements.
+        """
+        from scaffolding.samplers import example_length
+
+        if self.meta['single_values']:
+            return None
+
+        lengths = []
+        for idx, (_, records) in enumerate(self.index):
+            kind, _, _, _, shape = records[length_index]
+            length = stored_length(kind, shape, length_dim)
+            lengths.append(example_length(self[idx][length_index], length_dim) if length is None else length)
+        return lengths
+
+    def get_shard(self, shard_id):
+        if shard_id not in self.shards:
+            path = os.path.join(self.path, shard_name(shard_id))
+            if os.path.getsize(path) == 0:
+                # empty files can not be memory-mapped
+                self.shards[shard_id] = b''
+            else:
+                with open(path, 'rb') as f:
+                    self.shards[shard_id] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.shards[shard_id]
+
+    def __getitems__(self, indices):
+        """Returns examples with given indices, used by DataLoader (PyTorch 2.0+) to fetch a batch at once"""
+        self.read_ahead(indices)
+        return [self[idx] for idx in indices]
+
+    def can_read_ahead(self):
+        return True
+
+    def read_ahead(self, indices):
+        """Asks the kernel to read bytes of given examples in the background"""
+        ranges = {}
+        for idx in indices:
+            shard_id, records = self.index[idx]
+            if records:
+                start = records[0][1]
+                end = records[-1][1] + records[-1][2]
+                ranges.setdefault(shard_id, []).append((start, end))
+
+        for shard_id, shard_ranges in ranges.items():
+            shard = self.get_shard(shard_id)
+            if not hasattr(shard, 'madvise'):
+                continue
+
+            # neighbouring examples are merged into a single request
+            merged = []
+            for start, end in sorted(shard_ranges):
+                start -= start % mmap.PAGESIZE
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+
+            for start, end in merged:
+                shard.madvise(mmap.MADV_WILLNEED, start, end - start)
+
+    def __getstate__(self):
+        # memory maps can not be pickled, every DataLoader worker opens its own ones
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
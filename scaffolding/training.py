@@ -1,12 +1,32 @@
+import os
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
-from .utils import save_session, switch_to_train_mode, switch_to_evaluation_mode
+from .utils import save_session, switch_to_train_mode, switch_to_evaluation_mode, IndexedBatch
+from .caching import FeatureCache
+from .memory import reset_peak_memory, peak_memory, format_memory
 from .metrics import MovingAverage
 from .formatters import Formatter
+from .scheduling import build_dependencies, select_nodes, run_graph
+from .pipeline_parallel import split_batch, weigh_micro_batches, run_pipeline_parallel, find_batch_size, \
+    split_value
+from .hogwild import share_pipeline_memory, run_hogwild_epoch
+from .distributed import is_distributed, is_main_process, get_rank, all_reduce_gradients, broadcast_parameters, \
+    barrier
+from .resumption import get_rng_states
 
 
 def train(session, stat_ivl=10):
     data_pipeline = session.data_pipeline
-    train_pipeline = session.restore_from_last_checkpoint()
+
+    if is_main_process():
+        session.prepare_checkpoints()
+    barrier()
+
+    train_pipeline = session.restore_from_last_checkpoint(resume=True)
+    progress = session.mid_epoch_progress()
     loss_fn = session.criterion
     metrics = session.metrics
     epochs = session.num_epochs
@@ -16,18 +36,80 @@ def train(session, stat_ivl=10):
     if 'loss' in metrics:
         metrics['loss'] = loss_fn
 
-    train_loader, test_loader = data_pipeline.get_data_loaders()
+    if is_distributed():
+        broadcast_parameters(train_pipeline)
+
+    feature_caches = attach_feature_caches(train_pipeline, session, enabled=session.mode != "hogwild")
+
+    # hogwild workers are forked every epoch, loader workers of the parent must not outlive an iteration
+    loader_overrides = {'persistent_workers': False} if session.mode == "hogwild" else {}
+    train_loader, test_loader = data_pipeline.get_data_loaders(train_pipeline.batch_adapter,
+                                                               indexed=bool(feature_caches),
+                                                               resumable=bool(session.mid_epoch_checkpoints),
+                                                               **loader_overrides)
+    train_batches = CachedBatches(train_loader, train_pipeline, num_batches=32)
+    test_batches = CachedBatches(test_loader, train_pipeline, num_batches=32)
     formatter = Formatter()
 
+    # in data-parallel training, only the first process reports progress and writes to the session
+    main_process = is_main_process()
+
+    if session.mode == "hogwild":
+        share_pipeline_memory(train_pipeline)
+
     for epoch in range(start_epoch, start_epoch + epochs):
-        trainer = Trainer(train_loader, train_pipeline, loss_fn)
-        print_metrics = PrintMetrics(metrics, stat_ivl, epoch, formatter)
-        trainer.add_callback(print_metrics)
-        trainer.run_epoch()
+        if hasattr(train_loader.batch_sampler, 'set_epoch'):
+            train_loader.batch_sampler.set_epoch(epoch)
+        elif hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(epoch)
+
+        start_iteration = 0
+        if progress and progress["epoch"] == epoch:
+            # the sampler draws the same batches as in the interrupted run and skips consumed ones
+            start_iteration = progress["iteration"]
+            train_loader.batch_sampler.resume(start_iteration, progress["rng_states"])
+            if main_process:
+                print(f'Resuming epoch {epoch} from iteration {start_iteration}')
+
+        reset_peak_memory()
+
+        if session.mode == "hogwild":
+            # progress is printed by the first worker only
+            make_callbacks = lambda rank: [PrintMetrics(metrics, stat_ivl, epoch, formatter)] if rank == 0 else []
+            run_hogwild_epoch(data_pipeline, train_loader.dataset, train_pipeline, loss_fn, epoch,
+                              session.num_processes, make_callbacks, session.accumulation_steps)
+        else:
+            if session.mode == "pipeline_parallel":
+                trainer = PipelineParallelTrainer(train_loader, train_pipeline, loss_fn,
+                                                  session.accumulation_steps, **session.pipeline_parallel)
+            else:
+                trainer = Trainer(train_loader, train_pipeline, loss_fn, session.accumulation_steps)
+
+            if main_process:
+                print_metrics = PrintMetrics(metrics, stat_ivl, epoch, formatter)
+                trainer.add_callback(print_metrics)
+                if checkpoints_dir and session.mid_epoch_checkpoints:
+                    trainer.add_callback(MidEpochCheckpoints(session, train_pipeline, epoch, start_iteration,
+                                                             session.accumulation_steps,
+                                                             **session.mid_epoch_checkpoints))
+            trainer.run_epoch(start_iteration)
+
+        for cache in feature_caches:
+            cache.flush()
+
+        if not main_process:
+            continue
+
+        # hogwild workers are separate processes, so only memory of the parent is measured in that mode
+        print(f'\r{formatter.format_epoch(epoch)} peak memory {format_memory(peak_memory())}')
+
+        batch_sampler = train_loader.batch_sampler
+        if hasattr(batch_sampler, 'padding_waste'):
+            print(f'\r{formatter.format_epoch(epoch)} padding waste {batch_sampler.padding_waste:.2%}')
 
         switch_to_evaluation_mode(train_pipeline)
 
-        train_metrics, val_metrics = compute_epoch_metrics(train_pipeline, train_loader, test_loader, metrics)
+        train_metrics, val_metrics = compute_epoch_metrics(train_pipeline, train_batches, test_batches, metrics)
         session.log_metrics(epoch, train_metrics, val_metrics)
         epoch_str = formatter.format_epoch(epoch)
         train_metrics_str = formatter.format_metrics(train_metrics, validation=False)
@@ -38,6 +120,63 @@ def train(session, stat_ivl=10):
         if checkpoints_dir:
             session.make_checkpoint(train_pipeline, epoch)
 
+    session.wait_for_checkpoints()
+
+
+def attach_feature_caches(train_pipeline, session, enabled=True):
+    """Creates feature caches for frozen nodes that cache their outputs, returns a list of them
+
+    Every data-parallel process reads its own part of training data, so it gets its own caches.
+    Caching is disabled in hogwild mode, where worker processes would write to the same files.
+    """
+    caches = []
+    for node in train_pipeline:
+        if node.cache_outputs and enabled:
+            cache_dir = os.path.join(session.path, 'feature_cache', str(get_rank()), node.name)
+            batch_dims = node.cache_outputs.get("batch_dims", {}) if isinstance(node.cache_outputs, dict) else {}
+            node.feature_cache = FeatureCache(cache_dir, [batch_dims.get(name, 0) for name in node.outputs])
+            caches.append(node.feature_cache)
+    return caches
+
+
+class MidEpochCheckpoints:
+    """Callback making checkpoints of an unfinished epoch every given number of iterations or seconds
+
+    Checkpoints are only made at ends of gradient accumulation windows, when no gradients are pending.
+    """
+    def __init__(self, session, train_pipeline, epoch, start_iteration=0, accumulation_steps=1,
+                 every_iterations=None, every_seconds=None):
+        self.session = session
+        self.train_pipeline = train_pipeline
+        self.epoch = epoch
+        self.accumulation_steps = accumulation_steps
+        self.every_iterations = every_iterations
+        self.every_seconds = every_seconds
+
+        self.last_iteration = start_iteration
+        self.last_time = time.monotonic()
+
+    def __call__(self, iteration_log):
+        iterations_done = iteration_log.iteration + 1
+        if iterations_done % self.accumulation_steps or iterations_done == iteration_log.num_iterations:
+            # the end of an epoch gets a regular checkpoint
+            return
+
+        due_by_iterations = (self.every_iterations and
+                             iterations_done - self.last_iteration >= self.every_iterations)
+        due_by_time = self.every_seconds and time.monotonic() - self.last_time >= self.every_seconds
+        if not (due_by_iterations or due_by_time):
+            return
+
+        progress = {
+            "epoch": self.epoch,
+            "iteration": iterations_done,
+            "rng_states": get_rng_states()
+        }
+        self.session.make_mid_epoch_checkpoint(self.train_pipeline, self.epoch, progress)
+        self.last_iteration = iterations_done
+        self.last_time = time.monotonic()
+
 
 class PrintMetrics:
     def __init__(self, metrics, ivl, epoch, format_fn):
@@ -75,6 +214,7 @@ def compute_epoch_metrics(train_pipeline, train_loader, test_loader, metrics):
 
 def evaluate(val_pipeline, dataloader, metrics, num_batches):
     moving_averages = {metric_name: MovingAverage() for metric_name in metrics}
+    required_outputs = metric_arguments(metrics)
 
     with torch.no_grad():
         for i, batch in enumerate(dataloader):
@@ -82,34 +222,94 @@ def evaluate(val_pipeline, dataloader, metrics, num_batches):
                 break
 
             inputs, targets = val_pipeline.adapt_batch(batch)
-            all_outputs = val_pipeline(inputs, inference_mode=False)
+            all_outputs = val_pipeline(inputs, inference_mode=False, required_outputs=required_outputs)
             update_running_metrics(moving_averages, metrics, all_outputs, targets)
 
     return {metric_name: avg.value for metric_name, avg in moving_averages.items()}
 
 
+class CachedBatches:
+    """Fixed subset of adapted batches that is read from a data loader only once.
+
+    Batches are fetched lazily on the first pass and reused on every subsequent one,
+    so that computing per-epoch metrics does not pay for starting new iterators,
+    shuffling and decoding examples all over again.
+    """
+    def __init__(self, data_loader, prediction_pipeline, num_batches):
+        self.data_loader = data_loader
+        self.prediction_pipeline = prediction_pipeline
+        self.num_batches = num_batches
+        self.batches = None
+
+    def __iter__(self):
+        if self.batches is None:
+            self.batches = list(self.fetch())
+        return iter(self.batches)
+
+    def __len__(self):
+        return min(self.num_batches, len(self.data_loader))
+
+    def fetch(self):
+        for i, batch in enumerate(self.data_loader):
+            if i >= self.num_batches:
+                break
+
+            inputs, targets = self.prediction_pipeline.adapt_batch(batch)
+            yield {"inputs": inputs, "targets": targets}
+
+
+def metric_arguments(metrics):
+    """Returns names of all values that metrics read"""
+    names = set()
+    for metric in metrics.values():
+        names.update(metric.argument_names())
+    return names
+
+
 def update_running_metrics(moving_averages, metrics, outputs, targets):
     for metric_name, metric in metrics.items():
         moving_averages[metric_name].update(metric(outputs, targets))
 
 
 class Trainer:
-    def __init__(self, data_loader, prediction_pipeline, loss_fn):
+    def __init__(self, data_loader, prediction_pipeline, loss_fn, accumulation_steps=1):
+        """
+        :param accumulation_steps: number of batches whose gradients are accumulated before optimizers
+        make a step; the loss of every batch is divided by the number of batches in its accumulation window
+        """
         self.data_loader = data_loader
         self.prediction_pipeline = prediction_pipeline
         self.loss_fn = loss_fn
+        self.accumulation_steps = accumulation_steps
         self.callbacks = []
 
     def add_callback(self, cb):
         self.callbacks.append(cb)
 
-    def run_epoch(self):
+    def run_epoch(self, start_iteration=0):
+        """
+        :param start_iteration: number of batches of the epoch already done; the data loader must
+        start after them (see ResumableBatchSampler)
+        """
         switch_to_train_mode(self.prediction_pipeline)
 
         num_iterations = len(self.data_loader)
-        for i, batch in enumerate(self.data_loader):
+        for i, batch in enumerate(self.data_loader, start_iteration):
+            indices = batch.indices if isinstance(batch, IndexedBatch) else None
             inputs, targets = self.prediction_pipeline.adapt_batch(batch)
-            loss, outputs = self.train_on_batch(inputs, targets)
+
+            position = i % self.accumulation_steps
+            # the last window of an epoch may have fewer batches than accumulation_steps
+            window_size = min(self.accumulation_steps, num_iterations - (i - position))
+
+            if position == 0:
+                self.zero_grad()
+
+            loss, outputs = self.forward_backward(inputs, targets, indices, loss_scale=1. / window_size)
+
+            if position == window_size - 1:
+                self.step()
+
             self.invoke_callbacks(
                 IterationLogEntry(i, num_iterations, inputs, outputs, targets, loss)
             )
@@ -118,19 +318,73 @@ class Trainer:
         for cb in self.callbacks:
             cb(log_entry)
 
-    def train_on_batch(self, inputs, targets):
-        for node in self.prediction_pipeline:
+    def train_on_batch(self, inputs, targets, indices=None):
+        self.zero_grad()
+        loss, outputs = self.forward_backward(inputs, targets, indices)
+        self.step()
+        return loss, outputs
+
+    def trained_nodes(self):
+        return [node for node in self.prediction_pipeline if not node.frozen]
+
+    def zero_grad(self):
+        for node in self.trained_nodes():
             node.optimizer.zero_grad()
 
-        outputs = self.prediction_pipeline(inputs, inference_mode=False)
+    def forward_backward(self, inputs, targets, indices=None, loss_scale=1.):
+        """Computes the loss and accumulates its gradients scaled by loss_scale
+
+        :return: a tuple of (unscaled loss, outputs)
+        """
+        outputs = self.prediction_pipeline(inputs, inference_mode=False, indices=indices)
 
         loss = self.loss_fn(outputs, targets)
-        loss.backward()
+        (loss * loss_scale).backward()
+        return loss, outputs
 
-        for node in self.prediction_pipeline:
+    def step(self):
+        if is_distributed():
+            all_reduce_gradients(self.prediction_pipeline)
+
+        for node in self.trained_nodes():
             node.optimizer.step()
 
-        return loss, outputs
+
+class PipelineParallelTrainer(Trainer):
+    """Trainer running every node of a pipeline in its own thread over micro-batches of a batch
+
+    Gradients of all micro-batches are accumulated before the optimizer of each node makes a step.
+    """
+    def __init__(self, data_loader, prediction_pipeline, loss_fn, accumulation_steps=1,
+                 num_micro_batches=4, batch_dims=None):
+        """
+        :param num_micro_batches: number of micro-batches every batch is split into
+        :param batch_dims: dictionary mapping names of inputs, targets and outputs to their batch dimension
+        (e.g. 1 for a hidden state of a recurrent network); other values are split along dimension 0
+        """
+        super().__init__(data_loader, prediction_pipeline, loss_fn, accumulation_steps)
+        self.num_micro_batches = num_micro_batches
+        self.batch_dims = batch_dims or {}
+
+    def forward_backward(self, inputs, targets, indices=None, loss_scale=1.):
+        self.prediction_pipeline.inputs_to(inputs)
+        micro_batches = split_batch(inputs, targets, self.num_micro_batches, self.batch_dims)
+        micro_batches = weigh_micro_batches(micro_batches, self.loss_fn)
+
+        # dataset indices of examples of every micro-batch, so that nodes can use their feature caches
+        micro_indices = None
+        if indices is not None:
+            sizes = [find_batch_size(next(iter(micro_inputs.values())), self.batch_dims)
+                     for micro_inputs, _, _ in micro_batches]
+            micro_indices = split_value(list(indices), sizes, 0)
+
+        def scaled_loss_fn(outputs, micro_targets):
+            return self.loss_fn(outputs, micro_targets) * loss_scale
+
+        loss, outputs = run_pipeline_parallel(list(self.prediction_pipeline), micro_batches,
+                                              scaled_loss_fn, self.batch_dims, self.prediction_pipeline.autocast,
+                                              micro_indices)
+        return loss / loss_scale, outputs
 
 
 class IterationLogEntry:
@@ -144,29 +398,79 @@ class IterationLogEntry:
 
 
 class PredictionPipeline:
-    def __init__(self, model, device, batch_adapter):
+    def __init__(self, model, device, batch_adapter, precision="fp32"):
+        """
+        :param precision: either "fp32" or "bf16"; in the latter case nodes run under bfloat16 autocast
+        """
         self.model = model
         self.device = device
         self.batch_adapter = batch_adapter
+        self.precision = precision
+
+        self.executor = None
+        self.executor_pid = None
 
     def adapt_batch(self, batch):
-        batch = self.batch_adapter.adapt(*batch)
+        if isinstance(batch, IndexedBatch):
+            batch = batch.batch
+
+        if not isinstance(batch, dict):
+            # batch has not been adapted by a collator in DataLoader workers yet
+            batch = self.batch_adapter.adapt(*batch)
         return batch["inputs"], batch.get("targets")
 
     def __iter__(self):
         return iter(self.model)
 
-    def __call__(self, inputs, inference_mode=False):
+    def __call__(self, inputs, inference_mode=False, required_outputs=None, indices=None):
+        """Runs nodes of the pipeline in order of their dependencies
+
+        :param inputs: inputs of a batch (a dictionary mapping node names to dictionaries of values)
+        :param inference_mode: whether to call run_inference method of nodes instead of forward
+        :param required_outputs: names of outputs to compute; nodes whose outputs are not needed to compute
+        them are skipped. When omitted, all nodes are run
+        :return: a dictionary with outputs of all nodes that were run. When required_outputs are given and
+        gradients are disabled, intermediate outputs are released right after their last reader is done
+        and only required ones are returned
+        :param indices: optional dataset indices of examples of the batch (used by nodes with feature caches)
+        """
         self.inputs_to(inputs)
 
-        all_outputs = {}
-        for node in self.model:
-            outputs = node(inputs, all_outputs, inference_mode)
-            all_outputs.update(
-                dict(zip(node.outputs, outputs))
-            )
-
-        return all_outputs
+        nodes = list(self.model)
+        dependencies = build_dependencies(nodes)
+        selected = select_nodes(nodes, dependencies, required_outputs)
+
+        def run_node(node, prev_outputs):
+            # autocast state is thread local, so it is entered for every node rather than once per call
+            with self.autocast():
+                outputs = node(inputs, prev_outputs, inference_mode, indices)
+            # cached outputs are read into CPU memory
+            outputs = [value.to(self.device) if hasattr(value, 'device') else value for value in outputs]
+            return dict(zip(node.outputs, outputs))
+
+        keep = None
+        if required_outputs is not None and not torch.is_grad_enabled():
+            keep = set(required_outputs)
+
+        return run_graph(nodes, dependencies, selected, run_node, self.get_executor, keep)
+
+    def autocast(self):
+        if self.precision == "bf16":
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        return nullcontext()
+
+    def get_executor(self):
+        # threads of a pool do not survive fork (e.g. in hogwild workers), so a forked process makes its own
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=min(len(self.model), os.cpu_count() or 1))
+            self.executor_pid = os.getpid()
+        return self.executor
+
+    def shutdown_executor(self):
+        """Stops threads of the pool running nodes, a new pool is made when it is needed again"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
 
     def inputs_to(self, inputs):
         for k, mapping in inputs.items():
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import time
+from itertools import product
+
+
+def autotune_loader_params(data_pipeline, batch_adapter=None, autotune_config=None, cache_path=None):
+    """Picks the fastest combination of worker count and prefetch depth for the training loader
+
+    Runs a few short warm-up passes over the training set, one for every candidate combination,
+    and updates loader parameters of the data pipeline with the one yielding the most batches per second.
+    Combinations left when the time budget runs out are not tried.
+
+    :param data_pipeline: data pipeline whose loader parameters are tuned
+    :type data_pipeline: scaffolding.parse.DataPipeline
+    :param batch_adapter: batch adapter composed into collator when data pipeline adapts batches in workers
+    :param autotune_config: either True or a dictionary with optional keys
+    "num_workers", "prefetch_factor" (lists of candidate values), "num_batches" and "max_seconds"
+    :param cache_path: optional path of a JSON file with results of an earlier run (see autotune_cache_path),
+    which are used instead of measuring again when it exists, and are saved there otherwise
+    :return: a list of (num_workers, prefetch_factor, batches_per_second) tuples sorted by throughput
+    """
+    if not isinstance(autotune_config, dict):
+        autotune_config = {}
+
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, encoding='utf-8') as f:
+            results = [tuple(result) for result in json.loads(f.read())]
+        print(f'Using loader parameters tuned earlier ({cache_path})')
+    else:
+        results = measure_loader_params(data_pipeline, batch_adapter, autotune_config)
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(results))
+
+    num_workers, prefetch_factor, _ = results[0]
+    data_pipeline.loader_params.update(num_workers=num_workers, prefetch_factor=prefetch_factor)
+    return results
+
+
+def measure_loader_params(data_pipeline, batch_adapter, autotune_config):
+    workers_options = autotune_config.get("num_workers", default_workers_options())
+    prefetch_options = autotune_config.get("prefetch_factor", [2, 4, 8])
+    num_batches = autotune_config.get("num_batches", 20)
+    max_seconds = autotune_config.get("max_seconds", 60)
+
+    train_set, _ = data_pipeline.get_datasets()
+    collate_fn = data_pipeline.get_collate_fn(batch_adapter)
+    # batch sampler may need a full pass over the dataset to build, so it is shared by all runs
+    batch_sampler = data_pipeline.make_batch_sampler(train_set, shuffle=True)
+
+    deadline = time.perf_counter() + max_seconds
+
+    results = []
+    for num_workers, prefetch_factor in product(workers_options, prefetch_options):
+        if num_workers == 0 and prefetch_factor != prefetch_options[0]:
+            # prefetching only applies to worker processes, so one run is enough
+            continue
+
+        if results and time.perf_counter() >= deadline:
+            print(f'Loader tuning took over {max_seconds} seconds, remaining combinations are skipped')
+            break
+
+        loader = data_pipeline.make_loader(train_set, collate_fn, shuffle=True, batch_sampler=batch_sampler,
+                                           num_workers=num_workers, prefetch_factor=prefetch_factor,
+                                           persistent_workers=False)
+        rate = measure_throughput(loader, num_batches, deadline)
+        print(f'num_workers {num_workers:3}, prefetch_factor {prefetch_factor:3}: {rate:8.2f} batches/s')
+        results.append((num_workers, prefetch_factor, rate))
+
+    results.sort(key=lambda t: t[2], reverse=True)
+    return results
+
+
+def autotune_cache_path(sessions_dir, data_config):
+    """Returns a path of a file with loader tuning results for a given data config kept in sessions_dir
+
+    Results are keyed by data config and CPU count, so that sessions created later on the same machine
+    with the same data reuse them.
+    """
+    s = json.dumps({'data': data_config, 'num_cpus': os.cpu_count()}, sort_keys=True, default=str)
+    key = hashlib.sha256(s.encode('utf-8')).hexdigest()[:32]
+    return os.path.join(sessions_dir, 'loader_autotune', f'{key}.json')
+
+
+def default_workers_options():
+    num_cpus = os.cpu_count() or 1
+    options = [0]
+    num_workers = 1
+    while num_workers <= num_cpus:
+        options.append(num_workers)
+        num_workers *= 2
+    return options
+
+
+def measure_throughput(loader, num_batches, deadline=None):
+    """Returns a number of batches per second produced by a loader (excluding worker start up)
+
+    :param deadline: optional time (as given by time.perf_counter) to stop at even if fewer batches were fetched
+    """
+    iterator = iter(loader)
+
+    try:
+        next(iterator)
+    except StopIteration:
+        return 0.
+
+    num_fetched = 0
+    t0 = time.perf_counter()
+    for _ in range(num_batches):
+        if deadline is not None and num_fetched and time.perf_counter() >= deadline:
+            break
+
+        try:
+            next(iterator)
+        except StopIteration:
+            break
+        num_fetched += 1
+
+    elapsed = time.perf_counter() - t0
+
+    # shut down worker processes before the next run
+    del iterator
+    return num_fetched / elapsed if elapsed > 0 else 0.
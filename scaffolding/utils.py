@@ -27,6 +27,9 @@ class DecoratedInstance:
         return self.instance(*args, **kwargs)
 
     def __getattr__(self, attr):
+        if attr == 'instance':
+            # attribute is not set yet (e.g. when unpickling in a spawned worker process)
+            raise AttributeError(attr)
         return getattr(self.instance, attr)
 
     def to_dict(self):
@@ -127,6 +130,18 @@ class DatasetSlice(Dataset):
     def __len__(self):
         return self.index_to - self.index_from
 
+    def can_read_ahead(self):
+        return can_read_ahead(self.ds)
+
+    def read_ahead(self, indices):
+        self.ds.read_ahead([idx + self.index_from for idx in indices])
+
+
+def can_read_ahead(dataset):
+    """Tells whether a dataset (or a dataset wrapped by it) can prefetch examples, see ShardedDataset.read_ahead"""
+    method = getattr(dataset, 'can_read_ahead', None)
+    return bool(method and method())
+
 
 def instantiate_class(dotted_path, *args, **kwargs):
     parts = dotted_path.split('.')
@@ -184,29 +199,15 @@ def import_entity(dotted_path):
         raise EntityImportError(error_msg)
 
 
-def save_session(train_pipeline, epoch, checkpoints_dir):
-    epoch_dir = os.path.join(checkpoints_dir, str(epoch))
-
-    os.makedirs(epoch_dir, exist_ok=True)
-
-    for number, pipe in enumerate(train_pipeline, start=1):
-        save_path = os.path.join(epoch_dir, pipe.name)
-        d = {
-            'name': pipe.name,
-            'number': number,
-            'inputs': pipe.inputs,
-            'outputs': pipe.outputs,
-            'epoch': epoch
-        }
-        d.update(pipe.net.to_dict())
-        d.update(pipe.optimizer.to_dict())
-
-        torch.save(d, save_path)
+def save_session(train_pipeline, epoch, checkpoints_dir, deduplicate=False, retention=None):
+    from scaffolding.checkpoints import checkpoint_dicts, write_checkpoint
+    write_checkpoint(checkpoints_dir, epoch, checkpoint_dicts(train_pipeline, epoch), deduplicate, retention)
 
 
 def switch_to_train_mode(prediction_pipeline):
     for node in prediction_pipeline:
-        node.net.instance.train()
+        # frozen nodes stay in evaluation mode (e.g. batch norm statistics are not updated)
+        node.net.instance.train(not node.frozen)
 
 
 def switch_to_evaluation_mode(prediction_pipeline):
@@ -215,39 +216,68 @@ def switch_to_evaluation_mode(prediction_pipeline):
 
 
 def load_session(checkpoints_dir, epoch, device, inference_mode=False):
-    from scaffolding.parse import Node, SerializableModel, SerializableOptimizer
+    """Loads nodes of a pipeline saved at a given epoch, reading files of nodes in parallel
+
+    In inference mode tensors are memory-mapped (when PyTorch supports it) and optimizers are
+    neither read nor constructed, such nodes have their optimizer set to None.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from scaffolding.checkpoints import CheckpointCatalog, node_file_names
 
     epoch_dir = os.path.join(checkpoints_dir, str(epoch))
 
-    nodes_with_numbers = []
-    for file_name in os.listdir(epoch_dir):
-        path = os.path.join(epoch_dir, file_name)
-        checkpoint = torch.load(path)
+    entry = CheckpointCatalog(checkpoints_dir).entry(epoch)
+    if entry and "nodes" in entry:
+        file_names = [node["name"] for node in entry["nodes"]]
+    else:
+        file_names = node_file_names(epoch_dir)
 
-        serializable_model = SerializableModel.from_dict(checkpoint)
-        serializable_model.instance.to(device)
+    def load(file_name):
+        return load_node(checkpoints_dir, os.path.join(epoch_dir, file_name), device, inference_mode)
+
+    with ThreadPoolExecutor(max_workers=min(len(file_names), os.cpu_count() or 1) or 1) as executor:
+        nodes_with_numbers = list(executor.map(load, file_names))
+
+    nodes_with_numbers.sort(key=lambda t: t[1])
+    return [t[0] for t in nodes_with_numbers]
+
+
+def load_node(checkpoints_dir, path, device, inference_mode=False):
+    """Returns a tuple of a node restored from its checkpoint file and its number in the pipeline"""
+    from scaffolding.parse import Node, SerializableModel, SerializableOptimizer
+    from scaffolding.checkpoints import read_checkpoint
+
+    checkpoint = read_checkpoint(path, checkpoints_dir, mmap=inference_mode, with_optimizer=not inference_mode)
+
+    serializable_model = SerializableModel.from_dict(checkpoint, assign=inference_mode)
+    serializable_model.instance.to(device)
+
+    if inference_mode:
+        serializable_optimizer = None
+    else:
         serializable_optimizer = SerializableOptimizer.from_dict(
             checkpoint, serializable_model.instance
         )
 
-        # todo: consider doing this outside the function call
-        if inference_mode:
-            serializable_model.instance.eval()
-        else:
-            serializable_model.instance.train()
+    # todo: consider doing this outside the function call
+    if inference_mode or checkpoint.get("frozen", False):
+        serializable_model.instance.eval()
+    else:
+        serializable_model.instance.train()
 
-        node = Node(name=checkpoint["name"], serializable_model=serializable_model,
-                    serializable_optimizer=serializable_optimizer, inputs=checkpoint["inputs"],
-                    outputs=checkpoint["outputs"])
-        nodes_with_numbers.append((node, checkpoint["number"]))
-
-    nodes_with_numbers.sort(key=lambda t: t[1])
-    return [t[0] for t in nodes_with_numbers]
+    node = Node(name=checkpoint["name"], serializable_model=serializable_model,
+                serializable_optimizer=serializable_optimizer, inputs=checkpoint["inputs"],
+                outputs=checkpoint["outputs"], frozen=checkpoint.get("frozen", False),
+                cache_outputs=checkpoint.get("cache_outputs", False),
+                compile_options=checkpoint.get("compile"),
+                activation_checkpointing=checkpoint.get("activation_checkpointing"))
+    return node, checkpoint["number"]
 
 
 def load_session_from_last_epoch(epochs_dir, device, inference_mode=False):
-    last_epoch = sorted(os.listdir(epochs_dir), key=lambda d: int(d), reverse=True)[0]
-    return load_session(epochs_dir, int(last_epoch), device, inference_mode)
+    from scaffolding.checkpoints import CheckpointCatalog
+    last_epoch = CheckpointCatalog(epochs_dir).latest()
+    return load_session(epochs_dir, last_epoch, device, inference_mode)
 
 
 def save_data_pipeline(data_pipeline, path):
@@ -294,6 +324,40 @@ class AdaptedCollator:
         return self.adapter.adapt(*batch)
 
 
+class IndexedDataset:
+    """Dataset returning examples together with their indices"""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, idx):
+        return idx, self.dataset[idx]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def can_read_ahead(self):
+        return can_read_ahead(self.dataset)
+
+    def read_ahead(self, indices):
+        self.dataset.read_ahead(indices)
+
+
+class IndexedBatch:
+    def __init__(self, indices, batch):
+        self.indices = indices
+        self.batch = batch
+
+
+class IndexedCollator:
+    """Collates examples of IndexedDataset, keeping their indices next to the collated batch"""
+    def __init__(self, collator):
+        self.collator = collator
+
+    def __call__(self, examples):
+        indices = [idx for idx, _ in examples]
+        return IndexedBatch(indices, self.collator([example for _, example in examples]))
+
+
 class WrappedDataset:
     def __init__(self, dataset, preprocessors):
         self.dataset = dataset
@@ -317,3 +381,9 @@ class WrappedDataset:
 
     def __len__(self):
         return len(self.dataset)
+
+    def can_read_ahead(self):
+        return can_read_ahead(self.dataset)
+
+    def read_ahead(self, indices):
+        self.dataset.read_ahead(indices)
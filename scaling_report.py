@@ -0,0 +1,80 @@
+import argparse
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from scaffolding.training import Trainer
+from scaffolding.distributed import launch, get_world_size, is_main_process, broadcast_parameters
+from scaffolding.utils import switch_to_train_mode
+from init import TrainingSession
+
+
+def benchmark_worker(session_path, num_batches, results_queue):
+    """Runs num_batches training iterations in every process and reports samples per second
+
+    Weights are updated in memory only, the session is left intact.
+    Number of samples is estimated as the number of batches times the batch size of the data pipeline.
+    """
+    session = TrainingSession(session_path)
+    data_pipeline = session.data_pipeline
+    train_pipeline = session.restore_from_last_checkpoint()
+    broadcast_parameters(train_pipeline)
+
+    train_loader, _ = data_pipeline.get_data_loaders(train_pipeline.batch_adapter)
+    trainer = Trainer(train_loader, train_pipeline, session.criterion)
+    switch_to_train_mode(train_pipeline)
+
+    iterator = iter(train_loader)
+
+    # the first iteration includes start up of loader workers, so it is not timed
+    inputs, targets = train_pipeline.adapt_batch(next(iterator))
+    trainer.train_on_batch(inputs, targets)
+    dist.barrier()
+
+    num_done = 0
+    t0 = time.perf_counter()
+    for batch in iterator:
+        if num_done >= num_batches:
+            break
+        inputs, targets = train_pipeline.adapt_batch(batch)
+        trainer.train_on_batch(inputs, targets)
+        num_done += 1
+
+    elapsed = torch.tensor([time.perf_counter() - t0])
+    num_samples = torch.tensor([num_done * data_pipeline.batch_size], dtype=torch.float64)
+
+    dist.all_reduce(elapsed, op=dist.ReduceOp.MAX)
+    dist.all_reduce(num_samples, op=dist.ReduceOp.SUM)
+
+    if is_main_process():
+        results_queue.put((get_world_size(), num_samples.item(), elapsed.item()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure training throughput (samples per second) versus number of data-parallel processes'
+    )
+    parser.add_argument('session_path', type=str, help='Path to the session directory')
+    parser.add_argument('--nproc', type=int, nargs='+', default=[1, 2, 4],
+                        help='Numbers of processes to try')
+    parser.add_argument('--num_batches', type=int, default=50, help='Number of timed iterations per process')
+    parser.add_argument('--port', type=int, default=29500, help='Port used by processes to communicate')
+
+    cmd_args = parser.parse_args()
+
+    queue = mp.get_context('spawn').SimpleQueue()
+
+    rows = []
+    for nproc in cmd_args.nproc:
+        launch(benchmark_worker, nproc, cmd_args.port, cmd_args.session_path, cmd_args.num_batches, queue)
+        rows.append(queue.get())
+
+    base_rate = None
+    print(f'{"nproc":>6} {"samples/s":>12} {"speedup":>8} {"efficiency":>10}')
+    for nproc, num_samples, elapsed in rows:
+        rate = num_samples / elapsed if elapsed > 0 else 0.
+        base_rate = base_rate or rate / nproc
+        speedup = rate / base_rate if base_rate else 0.
+        print(f'{nproc:6} {rate:12.2f} {speedup:8.2f} {speedup / nproc:10.2%}')
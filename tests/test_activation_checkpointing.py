@@ -0,0 +1,48 @@
+import pytest
+import torch
+from torch import nn
+
+from scaffolding.activation_checkpointing import enable_activation_checkpointing, reentrant_args
+from scaffolding.exceptions import InvalidParameterError
+
+
+def make_model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(4, 8), nn.Tanh(), nn.Linear(8, 2))
+
+
+def parameter_grads(model, x):
+    model.zero_grad()
+    model(x).sum().backward()
+    return [p.grad.clone() for p in model.parameters()]
+
+
+def test_parameters_get_gradients_when_inputs_do_not_require_grad():
+    x = torch.randn(3, 4)
+    expected = parameter_grads(make_model(), x)
+
+    model = make_model()
+    assert enable_activation_checkpointing(model, {"container": "", "every": 1}) == ['0', '1', '2']
+
+    for grad, expected_grad in zip(parameter_grads(model, x), expected):
+        assert torch.allclose(grad, expected_grad)
+
+
+def test_reentrant_args_make_an_input_require_grad():
+    x = torch.randn(3, 4)
+    ids = torch.tensor([1, 2])
+
+    args = reentrant_args((ids, x))
+    assert args[0] is ids
+    assert args[1].requires_grad and not x.requires_grad
+    assert reentrant_args((ids,)) is None
+
+
+def test_modules_with_running_stats_are_not_checkpointed():
+    model = nn.Sequential(nn.Linear(4, 4), nn.BatchNorm1d(4), nn.Linear(4, 2))
+
+    assert enable_activation_checkpointing(model, {"container": "", "every": 1}) == ['0', '2']
+    assert 'forward' not in model[1].__dict__
+
+    with pytest.raises(InvalidParameterError):
+        enable_activation_checkpointing(model, {"modules": ['1']})
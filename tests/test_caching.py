@@ -0,0 +1,29 @@
+import pytest
+import torch
+
+from scaffolding.caching import FeatureCache
+from scaffolding.exceptions import TrainingError
+
+
+def test_outputs_are_split_along_their_batch_dimensions(tmp_path):
+    torch.manual_seed(0)
+    # recurrent hidden state (num_layers, batch, hidden) next to a batch-first output
+    hidden = torch.randn(2, 3, 4)
+    logits = torch.randn(3, 5)
+
+    cache = FeatureCache(str(tmp_path / 'cache'), batch_dims=[1, 0])
+    cache.put([10, 11, 12], (hidden, logits))
+
+    cached_hidden, cached_logits = cache.get([12, 10])
+    assert torch.equal(cached_hidden, hidden[:, [2, 0]])
+    assert torch.equal(cached_logits, logits[[2, 0]])
+
+    cache.flush()
+    reopened = FeatureCache(str(tmp_path / 'cache'), batch_dims=[1, 0])
+    assert torch.equal(reopened.get([11])[0], hidden[:, [1]])
+
+
+def test_none_outputs_are_rejected(tmp_path):
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    with pytest.raises(TrainingError):
+        cache.put([0, 1], (torch.zeros(2, 3), None))
@@ -0,0 +1,69 @@
+import pytest
+import torch
+from torch import nn
+
+from scaffolding.metrics import Metric, MaskedMetric
+from scaffolding.pipeline_parallel import split_batch, weigh_micro_batches, run_pipeline_parallel
+
+
+class LinearNode:
+    """Minimal stand-in of a pipeline node: applies a linear layer to a batch input or to a previous output"""
+    def __init__(self, layer, source, output, input_node=None):
+        self.layer = layer
+        self.source = source
+        self.outputs = [output]
+        self.input_node = input_node
+
+    def __call__(self, batch_inputs, prev_outputs):
+        x = batch_inputs[self.input_node][self.source] if self.input_node else prev_outputs[self.source]
+        return (self.layer(x),)
+
+
+def make_nodes():
+    torch.manual_seed(0)
+    return [LinearNode(nn.Linear(4, 8), 'x', 'hidden', input_node='encoder'),
+            LinearNode(nn.Linear(8, 5), 'hidden', 'logits')]
+
+
+def permute_logits(logits, target):
+    return logits.permute(0, 2, 1), target
+
+
+def make_loss(reduction, masked):
+    criterion = nn.CrossEntropyLoss(reduction=reduction)
+    if masked:
+        return MaskedMetric('loss', criterion, ['logits', 'y'], permute_logits, torch.device('cpu'),
+                            target_name='y', lengths_name='lengths', ignore_index=criterion.ignore_index)
+    return Metric('loss', criterion, ['logits', 'y'], permute_logits, torch.device('cpu'))
+
+
+def make_batch():
+    torch.manual_seed(1)
+    inputs = {'encoder': {'x': torch.randn(6, 7, 4)}}
+    targets = {'y': torch.randint(0, 5, (6, 7)), 'lengths': torch.tensor([7, 1, 3, 7, 2, 5])}
+    return inputs, targets
+
+
+def gradients(nodes):
+    return [p.grad.clone() for node in nodes for p in node.layer.parameters()]
+
+
+@pytest.mark.parametrize('reduction, masked', [('mean', False), ('sum', False), ('mean', True), ('sum', True)])
+def test_micro_batch_gradients_equal_full_batch_gradients(reduction, masked):
+    inputs, targets = make_batch()
+    loss_fn = make_loss(reduction, masked)
+
+    nodes = make_nodes()
+    hidden = nodes[0](inputs, {})[0]
+    logits = nodes[1](inputs, {'hidden': hidden})[0]
+    expected_loss = loss_fn({'hidden': hidden, 'logits': logits}, targets)
+    expected_loss.backward()
+    expected_grads = gradients(nodes)
+
+    nodes = make_nodes()
+    micro_batches = weigh_micro_batches(split_batch(inputs, targets, 4, {}), loss_fn)
+    loss, _ = run_pipeline_parallel(nodes, micro_batches, loss_fn, {})
+
+    assert torch.allclose(loss, expected_loss.detach(), atol=1e-5)
+    for grad, expected in zip(gradients(nodes), expected_grads):
+        assert torch.allclose(grad, expected, atol=1e-5)
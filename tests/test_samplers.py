@@ -0,0 +1,53 @@
+from scaffolding.samplers import dataset_lengths, known_lengths
+from scaffolding.utils import DatasetSlice, WrappedDataset
+
+
+class ListDataset:
+    def __init__(self, examples, provide_lengths=True):
+        self.examples = examples
+        self.provide_lengths = provide_lengths
+        self.reads = 0
+
+    def __getitem__(self, idx):
+        self.reads += 1
+        return self.examples[idx]
+
+    def __len__(self):
+        return len(self.examples)
+
+    def lengths(self, length_index=0, length_dim=-1):
+        if not self.provide_lengths:
+            return None
+        return [len(example[length_index]) for example in self.examples]
+
+
+def make_examples():
+    return [('a' * i, 'b' * (2 * i)) for i in range(1, 7)]
+
+
+def test_slices_and_wrappers_delegate_to_lengths_of_dataset():
+    base = ListDataset(make_examples())
+    dataset = WrappedDataset(DatasetSlice(base, 2, 5), [lambda v: v + '!'])
+
+    assert dataset_lengths(dataset, length_index=1) == [6, 8, 10]
+    assert base.reads == 0
+
+
+def test_preprocessed_elements_are_read():
+    base = ListDataset(make_examples())
+    dataset = WrappedDataset(DatasetSlice(base, 2, 5), [lambda v: v + '!'])
+
+    assert dataset_lengths(dataset, length_index=0) == [4, 5, 6]
+    assert base.reads == 3
+
+
+def test_lengths_are_reused_by_datasets_with_same_key():
+    known_lengths.clear()
+    base = ListDataset(make_examples(), provide_lengths=False)
+
+    for _ in range(2):
+        dataset = WrappedDataset(DatasetSlice(base, 0, 4), [lambda v: v + '!'])
+        dataset.lengths_key = 'key'
+        assert dataset_lengths(dataset) == [2, 3, 4, 5]
+
+    assert base.reads == 4
@@ -0,0 +1,47 @@
+import torch
+from torch.utils.data import BatchSampler, DataLoader, SequentialSampler
+
+from scaffolding.parse import build_data_split
+from scaffolding.samplers import ReadAheadBatchSampler
+from scaffolding.shards import ShardedDataset, convert_to_shards
+from scaffolding.utils import SimpleSplitter, WrappedDataset, IndexedDataset, DatasetSlice, can_read_ahead
+
+
+def make_shards(tmp_path, num_examples=10):
+    path = str(tmp_path / 'shards')
+    examples = [(torch.arange(i + 1), i) for i in range(num_examples)]
+    convert_to_shards(examples, path, shard_size=64)
+    return path
+
+
+def test_read_ahead_reaches_shards_through_split_and_wrappers(tmp_path, monkeypatch):
+    path = make_shards(tmp_path)
+    data_dict = {"dataset_name": "scaffolding.shards.ShardedDataset", "dataset_kwargs": {"path": path}}
+    train_set, val_set = build_data_split(data_dict, SimpleSplitter(train_fraction=0.6))
+
+    requested = []
+    read_ahead = ShardedDataset.read_ahead
+
+    def recording_read_ahead(self, indices):
+        requested.append(list(indices))
+        read_ahead(self, indices)
+
+    monkeypatch.setattr(ShardedDataset, 'read_ahead', recording_read_ahead)
+
+    dataset = IndexedDataset(WrappedDataset(val_set, []))
+    assert can_read_ahead(dataset)
+
+    batch_sampler = ReadAheadBatchSampler(BatchSampler(SequentialSampler(dataset), 2, drop_last=False), dataset)
+    loader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=list)
+
+    batches = list(loader)
+
+    # indices of the validation slice are translated into indices of the whole dataset
+    assert requested == [[6, 7], [8, 9]]
+    assert [[idx for idx, _ in batch] for batch in batches] == [[0, 1], [2, 3]]
+    assert [example[1] for batch in batches for _, example in batch] == [6, 7, 8, 9]
+
+
+def test_datasets_without_read_ahead_are_left_alone():
+    assert not can_read_ahead(list(range(4)))
+    assert not can_read_ahead(WrappedDataset(DatasetSlice(list(range(4)), 1, 3), []))
@@ -1,6 +1,7 @@
 import argparse
 import json
 from scaffolding.training import train
+from scaffolding.distributed import launch
 from init import TrainingSession
 
 
@@ -11,20 +12,29 @@ def load_config(path):
     return json.loads(s)
 
 
+def train_worker(session_path):
+    train(TrainingSession(session_path))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Train ML pipeline according to a specified configuration file'
     )
     parser.add_argument('session_path', type=str, help='Path to the session file')
+    parser.add_argument('--nproc', type=int, default=1,
+                        help='Number of local processes running data-parallel replicas')
+    parser.add_argument('--port', type=int, default=29500, help='Port used by processes to communicate')
 
     cmd_args = parser.parse_args()
     path = cmd_args.session_path
 
-    session = TrainingSession(path)
-
     #store_path = os.path.join(checkpoints_dir, 'store.json')
 
-    train(session)
+    if cmd_args.nproc > 1:
+        launch(train_worker, cmd_args.nproc, cmd_args.port, path)
+    else:
+        session = TrainingSession(path)
+        train(session)
 
 
 # todo: refactor code more (achieve better cohesion, loose coupling)